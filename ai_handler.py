@@ -1,10 +1,19 @@
 import os
 import json
+import time
+import random
 import asyncio
+import httpx
+import openai
 from dotenv import load_dotenv
 from concurrent.futures import ThreadPoolExecutor
-from openai import OpenAI
-from config import DEFAULT_AI_MODES, API_SETTINGS
+from openai import OpenAI, AsyncOpenAI
+from config import DEFAULT_AI_MODES, API_SETTINGS, RESPONSE_CACHE_SETTINGS
+from response_cache import ResponseCache
+from context_builder import count_tokens, get_budgets, PreparedMessages
+from tracing import tracer, span, use_span, current_span
+from scheduler import FairScheduler, current_request_class
+from metrics import API_LATENCY, PROMPT_TOKENS, COMPLETION_TOKENS, API_ERRORS, API_RETRIES, IN_FLIGHT, SCHEDULER_WAIT, BACKEND_REQUESTS, MODEL_FALLBACKS
 
 # Load environment variables
 load_dotenv()
@@ -17,9 +26,166 @@ AI_MODEL = os.getenv('AI_MODEL', 'grok-3-mini-beta')
 # Use default AI modes from config
 AI_MODES = DEFAULT_AI_MODES
 
-# Create OpenAI client for xAI
-client = OpenAI(api_key=XAI_API_KEY, base_url=AI_API_URL)
-executor = ThreadPoolExecutor()
+# As many threads as API slots, so the scheduler is the only place requests wait
+executor = ThreadPoolExecutor(max_workers=API_SETTINGS.get("max_in_flight_requests", 32))
+
+# Errors worth retrying: the request may succeed if sent again
+RETRYABLE_ERRORS = (
+    asyncio.TimeoutError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.RateLimitError,
+    openai.InternalServerError
+)
+
+DEFAULT_ERROR_MESSAGE = "Sorry, I couldn't generate a response at this time."
+UNAVAILABLE_MESSAGE = "The AI service is temporarily unavailable. Please try again in a moment."
+
+class AIServiceError(Exception):
+    """Raised when no response could be generated; user_message is safe to show in Discord"""
+    
+    def __init__(self, message, user_message=DEFAULT_ERROR_MESSAGE):
+        super().__init__(message)
+        self.user_message = user_message
+
+class CircuitBreaker:
+    """Stops sending requests for a while after repeated failures"""
+    
+    def __init__(self, failure_threshold=None, reset_timeout=None, name="API"):
+        self.name = name
+        self.failure_threshold = failure_threshold or API_SETTINGS.get("circuit_failure_threshold", 5)
+        self.reset_timeout = reset_timeout or API_SETTINGS.get("circuit_reset_timeout", 30)
+        self.failures = 0
+        self.opened_at = None
+    
+    @property
+    def state(self):
+        """Get "closed", "open" or "half-open" (one trial request allowed)"""
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+    
+    def allow(self):
+        """Check whether a request may be sent"""
+        if self.state == "half-open":
+            # Let one trial request through and keep the rest failing fast until it finishes
+            self.opened_at = time.monotonic()
+            return True
+        return self.state == "closed"
+    
+    def record_success(self):
+        """Close the circuit after a successful request"""
+        self.failures = 0
+        self.opened_at = None
+    
+    def record_failure(self):
+        """Count a failure, opening the circuit at the threshold"""
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                print(f"Circuit breaker for {self.name} opened after {self.failures} consecutive failures")
+            self.opened_at = time.monotonic()
+
+def create_async_client(api_url, api_token):
+    """Create an asyncio client with a bounded keep-alive connection pool"""
+    limits = httpx.Limits(
+        max_connections=API_SETTINGS.get("max_connections", 100),
+        max_keepalive_connections=API_SETTINGS.get("max_keepalive_connections", 20),
+        keepalive_expiry=API_SETTINGS.get("keepalive_expiry", 60)
+    )
+    http_client = httpx.AsyncClient(limits=limits, timeout=API_SETTINGS.get("timeout", 30))
+    return AsyncOpenAI(api_key=api_token, base_url=api_url, http_client=http_client, max_retries=0)
+
+class APIBackend:
+    """One OpenAI-compatible endpoint and key, with its own concurrency cap, latency estimate and health"""
+    
+    def __init__(self, name, api_url, api_token, weight=1.0, max_concurrency=None):
+        self.name = name
+        self.api_url = api_url
+        self.api_token = api_token
+        self.weight = weight
+        self.max_concurrency = max_concurrency or API_SETTINGS.get("max_in_flight_requests", 32)
+        # Sync client for the thread pool fallback (retries are handled by AIHandler)
+        self.client = OpenAI(api_key=api_token, base_url=api_url, timeout=API_SETTINGS.get("timeout", 30), max_retries=0)
+        self.async_client = None
+        if API_SETTINGS.get("async_client", True):
+            self.async_client = create_async_client(api_url, api_token)
+        self.circuit_breaker = CircuitBreaker(name=name)
+        self.outstanding = 0
+        # Smoothed seconds per request (time to the first byte for streams); None until the first success
+        self.latency = None
+        # Rate-limited backends sit out until this time
+        self.cooldown_until = 0.0
+        # Replaced by update_api_config; closed once its last request finishes
+        self.retired = False
+    
+    @property
+    def state(self):
+        """Get "ok", "cooling down" or the circuit breaker state"""
+        if time.monotonic() < self.cooldown_until:
+            return "cooling down"
+        breaker = self.circuit_breaker.state
+        return "ok" if breaker == "closed" else f"circuit {breaker}"
+    
+    def is_healthy(self, now):
+        """Check whether the backend is in rotation (it may still be at its concurrency cap)"""
+        return now >= self.cooldown_until and self.circuit_breaker.state != "open"
+    
+    def score(self, default_latency):
+        """Lower is better: expected latency scaled by the work already sent here, per unit of weight"""
+        latency = self.latency if self.latency is not None else default_latency
+        return latency * (self.outstanding + 1) / self.weight
+    
+    def record_success(self, elapsed):
+        smoothing = API_SETTINGS.get("latency_smoothing", 0.2)
+        self.latency = elapsed if self.latency is None else smoothing * elapsed + (1 - smoothing) * self.latency
+        self.circuit_breaker.record_success()
+        BACKEND_REQUESTS.inc(self.name, "ok")
+    
+    def record_failure(self, error):
+        """Take a rate-limited backend out of rotation for a while; count other failures toward its breaker"""
+        if isinstance(error, openai.RateLimitError):
+            cooldown = API_SETTINGS.get("rate_limit_cooldown", 10)
+            try:
+                cooldown = float(error.response.headers.get("retry-after", cooldown))
+            except (AttributeError, TypeError, ValueError):
+                pass
+            self.cooldown_until = time.monotonic() + cooldown
+            print(f"API backend {self.name} is rate limited, resting it for {cooldown:.0f}s")
+            BACKEND_REQUESTS.inc(self.name, "rate_limited")
+        else:
+            self.circuit_breaker.record_failure()
+            BACKEND_REQUESTS.inc(self.name, "error")
+    
+    def close(self):
+        """Close the backend's clients"""
+        self.client.close()
+        if self.async_client:
+            try:
+                asyncio.get_running_loop().create_task(self.async_client.close())
+            except RuntimeError:
+                # No running loop: the connections go away with the process
+                pass
+
+def build_backends(api_url, api_token, specs=None):
+    """Create backends from specs (API_SETTINGS["backends"] by default), or one backend for the given URL and token"""
+    specs = API_SETTINGS.get("backends") if specs is None else specs
+    if not specs:
+        return [APIBackend("default", api_url, api_token)]
+    
+    backends = []
+    for index, spec in enumerate(specs):
+        token = os.getenv(spec["api_key_env"]) if spec.get("api_key_env") else spec.get("api_token", api_token)
+        backends.append(APIBackend(
+            spec.get("name", f"backend{index + 1}"),
+            spec.get("api_url", api_url),
+            token,
+            spec.get("weight", 1.0),
+            spec.get("max_concurrency")
+        ))
+    return backends
 
 class AIHandler:
     def __init__(self, api_url=None, api_token=None, model=None):
@@ -27,53 +193,370 @@ class AIHandler:
         self.api_url = api_url or AI_API_URL
         self.api_token = api_token or XAI_API_KEY
         self.model = model or AI_MODEL
-        self.client = client
-
-    def update_api_config(self, api_url=None, api_token=None, model=None):
-        """Update the API configuration"""
+        self.use_async_client = API_SETTINGS.get("async_client", True)
+        # Explicit API details mean one backend; otherwise use the configured list
+        self.backends = build_backends(self.api_url, self.api_token, [] if api_url or api_token else None)
+        # Set whenever a backend finishes a request, waking requests waiting for a free backend
+        self._backend_freed = asyncio.Event()
+        self.response_cache = ResponseCache() if RESPONSE_CACHE_SETTINGS.get("enabled", False) else None
+        # Caps concurrent API calls across all users, sharing them fairly between guilds
+        self.in_flight = FairScheduler(API_SETTINGS.get("max_in_flight_requests", 32))
+    
+    def update_api_config(self, api_url=None, api_token=None, model=None, backends=None):
+        """Update the API configuration, rebuilding the backends if the endpoint, key or backend list changed"""
         if api_url:
             self.api_url = api_url
         if api_token:
             self.api_token = api_token
         if model:
             self.model = model
-
-    async def generate_response(self, messages, max_tokens=None):
-        """Generate a response from the xAI API using the OpenAI SDK (sync call in thread pool)"""
-        def sync_call():
+        
+        if api_url or api_token or backends is not None:
+            # A new URL or key replaces the configured list with a single backend
+            old_backends = self.backends
+            self.backends = build_backends(self.api_url, self.api_token, backends or [])
+            for backend in old_backends:
+                backend.retired = True
+                if not backend.outstanding:
+                    backend.close()
+            self._backend_freed.set()
+    
+    async def warmup(self):
+        """Open pooled connections to every backend ahead of the first request"""
+        if not self.use_async_client:
+            return
+        
+        count = API_SETTINGS.get("prewarm_connections", 2)
+        results = await asyncio.gather(
+            *(backend.async_client.models.list() for backend in self.backends for _ in range(count)),
+            return_exceptions=True
+        )
+        failures = [r for r in results if isinstance(r, Exception)]
+        if failures:
+            print(f"Connection pre-warming failed: {failures[0]}")
+        else:
+            print(f"Pre-warmed {count} API connections to each of {len(self.backends)} backends")
+    
+    def _clean_messages(self, messages):
+        """Drop messages without a role or with empty content, keeping only API fields"""
+        # Prepared messages were validated as they were added
+        if isinstance(messages, PreparedMessages):
+            return messages
+        valid_messages = []
+        for msg in messages:
+            if 'role' in msg and 'content' in msg and msg['content'] is not None and msg['content'].strip():
+                # Only send the fields the API accepts
+                valid_messages.append({"role": msg["role"], "content": msg["content"]})
+        return valid_messages
+    
+    def _extract_content(self, completion):
+        """Get the reply text from a completion"""
+        content = completion.choices[0].message.content
+        if not content or not content.strip():
+            raise AIServiceError("API returned an empty response")
+        return content
+    
+    def _retry_delay(self, attempt):
+        """Exponential backoff with full jitter"""
+        base = API_SETTINGS.get("retry_base_delay", 0.5)
+        cap = API_SETTINGS.get("retry_max_delay", 8)
+        return random.uniform(0, min(cap, base * (2 ** attempt)))
+    
+    async def _acquire_backend(self):
+        """Claim the healthy backend with the lowest latency and load score, waiting if all are at their cap"""
+        while True:
+            now = time.monotonic()
+            healthy = [backend for backend in self.backends if backend.is_healthy(now)]
+            if not healthy:
+                # Wait out a short rate limit cooldown; fail fast while every backend is down
+                resting = [b.cooldown_until for b in self.backends if b.circuit_breaker.state != "open" and b.cooldown_until > now]
+                if resting and min(resting) - now <= API_SETTINGS.get("retry_max_delay", 8):
+                    await asyncio.sleep(min(resting) - now)
+                    continue
+                raise AIServiceError("no API backend is available", UNAVAILABLE_MESSAGE)
+            
+            ready = [backend for backend in healthy if backend.outstanding < backend.max_concurrency]
+            if ready:
+                # Backends without a measurement yet are assumed as fast as the fastest known one
+                known = [backend.latency for backend in healthy if backend.latency is not None]
+                default_latency = min(known) if known else 1.0
+                backend = min(ready, key=lambda b: b.score(default_latency))
+                # A half-open breaker lets a single trial request through
+                if backend.circuit_breaker.allow():
+                    backend.outstanding += 1
+                    return backend
+                continue
+            
+            self._backend_freed.clear()
+            await self._backend_freed.wait()
+    
+    def _release_backend(self, backend):
+        backend.outstanding -= 1
+        if backend.retired and not backend.outstanding:
+            backend.close()
+        self._backend_freed.set()
+    
+    async def _with_retries(self, call, hold_backend=False):
+        """Run call(backend) with a timeout on the best backend, retrying retryable errors on whichever is best next
+        
+        With hold_backend the backend stays claimed and is returned with the result; release it with _release_backend.
+        """
+        attempts = API_SETTINGS.get("retry_attempts", 3) + 1
+        for attempt in range(attempts):
+            backend = await self._acquire_backend()
+            held = False
+            started = time.monotonic()
             try:
-                # Validate and clean up messages
-                valid_messages = []
-                for msg in messages:
-                    if 'role' in msg and 'content' in msg and msg['content'] is not None and msg['content'].strip():
-                        valid_messages.append(msg)
-                
-                # If no valid messages, return error
-                if not valid_messages:
-                    print("No valid messages to send to API")
-                    return "Sorry, I couldn't generate a response at this time."
-                
-                # Debug info
-                print(f"Sending {len(valid_messages)} messages to API")
-                
-                completion = self.client.chat.completions.create(
-                    model=self.model,
+                with span("api_attempt", attempt=attempt + 1, backend=backend.name):
+                    result = await asyncio.wait_for(call(backend), API_SETTINGS.get("timeout", 30))
+                backend.record_success(time.monotonic() - started)
+                held = hold_backend
+                return (result, backend) if hold_backend else result
+            except RETRYABLE_ERRORS as e:
+                backend.record_failure(e)
+                if attempt + 1 >= attempts:
+                    raise AIServiceError(f"API request failed after {attempts} attempts: {e!r}") from e
+                delay = self._retry_delay(attempt)
+                API_RETRIES.inc()
+                print(f"Retryable API error from {backend.name} ({e!r}), retrying in {delay:.2f}s")
+            except AIServiceError:
+                raise
+            except Exception as e:
+                raise AIServiceError(f"API request failed: {e!r}") from e
+            finally:
+                if not held:
+                    self._release_backend(backend)
+            # Sleep without holding the backend; the retry goes to whichever backend is best by then
+            await asyncio.sleep(delay)
+    
+    def _start_request_span(self, name, mode, valid_messages):
+        """Start a span for an API request, sizing the payload only when the trace is sampled"""
+        request_span = tracer.start_span(name, mode=mode, message_count=len(valid_messages))
+        if request_span.sampled:
+            request_span.set(payload_bytes=sum(len(msg["content"].encode("utf-8")) for msg in valid_messages))
+        return request_span
+    
+    def _record_slot_wait(self, request_span, priority, started):
+        """Record how long a request waited for an API slot"""
+        waited = time.monotonic() - started
+        SCHEDULER_WAIT.observe(waited, priority)
+        request_span.set(in_flight_wait_ms=waited * 1000, priority=priority)
+    
+    def _record_request(self, mode, valid_messages, response, started):
+        """Record latency and token counts for a completed request"""
+        API_LATENCY.observe(time.monotonic() - started, mode)
+        if isinstance(valid_messages, PreparedMessages):
+            prompt_tokens = valid_messages.tokens
+        else:
+            prompt_tokens = sum(count_tokens(msg["content"]) for msg in valid_messages)
+        PROMPT_TOKENS.observe(prompt_tokens, mode)
+        COMPLETION_TOKENS.observe(count_tokens(response), mode)
+    
+    def get_mode_models(self, mode_id):
+        """Get the models a mode's requests try in order: its own model (or the default), then any fallback"""
+        mode_info = AI_MODES.get(mode_id, {})
+        model = mode_info.get("model") or self.model
+        # A mode with its own model falls back to the default one unless it names another
+        fallback_model = mode_info.get("fallback_model", self.model if mode_info.get("model") else None)
+        if fallback_model and fallback_model != model:
+            return [model, fallback_model]
+        return [model]
+    
+    def _mode_max_tokens(self, mode_id, max_tokens):
+        """Use the mode's reply token limit when the caller didn't give one"""
+        if max_tokens is None and mode_id in AI_MODES:
+            return get_budgets(AI_MODES[mode_id])[1]
+        return max_tokens
+    
+    def _fall_back(self, mode, models, index, error, request_span):
+        """Report a failed model; returns whether there is a fallback model left to try"""
+        if index + 1 >= len(models):
+            return False
+        print(f"Model {models[index]} failed ({error}), falling back to {models[index + 1]}")
+        MODEL_FALLBACKS.inc(mode)
+        request_span.set(fallback_model=models[index + 1])
+        return True
+    
+    async def generate_response(self, messages, max_tokens=None, cache=False, mode=None):
+        """Generate a response from the xAI API using the OpenAI SDK; raises AIServiceError on failure"""
+        # Validate and clean up messages
+        valid_messages = self._clean_messages(messages)
+        
+        # If no valid messages, there is nothing to send
+        if not valid_messages:
+            raise AIServiceError("No valid messages to send to API")
+        
+        models = self.get_mode_models(mode)
+        max_tokens = self._mode_max_tokens(mode, max_tokens)
+        
+        # Serve repeated prompts from the response cache when the caller allows it
+        cache_key = None
+        if cache and self.response_cache:
+            cache_key = self.response_cache.make_key(models[0], valid_messages, max_tokens)
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                return cached
+        
+        mode = mode or "unknown"
+        started = time.monotonic()
+        flow, priority = current_request_class()
+        with use_span(self._start_request_span("generate_response", mode, valid_messages)) as request_span:
+            request_span.set(model=models[0])
+            async with self.in_flight.slot(flow, priority):
+                self._record_slot_wait(request_span, priority, started)
+                IN_FLIGHT.inc()
+                try:
+                    for index, model in enumerate(models):
+                        try:
+                            response = await self._complete(valid_messages, model, max_tokens)
+                            break
+                        except AIServiceError as e:
+                            if not self._fall_back(mode, models, index, e, request_span):
+                                raise
+                except AIServiceError:
+                    API_ERRORS.inc(mode)
+                    raise
+                finally:
+                    IN_FLIGHT.dec()
+        self._record_request(mode, valid_messages, response, started)
+        
+        if cache_key:
+            self.response_cache.put(cache_key, response)
+        return response
+    
+    async def _complete(self, valid_messages, model, max_tokens):
+        """Send validated messages to the API and return the reply text"""
+        # Debug info
+        print(f"Sending {len(valid_messages)} messages to API")
+        
+        if self.use_async_client:
+            async def call(backend):
+                completion = await backend.async_client.chat.completions.create(
+                    model=model,
                     messages=valid_messages,
                     max_tokens=max_tokens
                 )
-                content = completion.choices[0].message.content
-                if not content or not content.strip():
-                    return "Sorry, I couldn't generate a response at this time."
-                return content
-            except Exception as e:
-                import traceback
-                print("xAI API Exception:", e)
-                traceback.print_exc()
-                return f"API Error: {e}"
-        
-        # Execute the API call in a thread pool and return the result
-        loop = asyncio.get_event_loop()
-        return await loop.run_in_executor(executor, sync_call)
+                return self._extract_content(completion)
+        else:
+            def sync_call(backend):
+                completion = backend.client.chat.completions.create(
+                    model=model,
+                    messages=valid_messages,
+                    max_tokens=max_tokens
+                )
+                return self._extract_content(completion)
+            
+            # Fall back to the sync client in a thread pool
+            async def call(backend):
+                loop = asyncio.get_event_loop()
+                attempt_span = current_span()
+                submitted = time.monotonic()
+                
+                def timed_call():
+                    # Time spent waiting for a free worker thread
+                    attempt_span.set(executor_wait_ms=(time.monotonic() - submitted) * 1000)
+                    return sync_call(backend)
+                return await loop.run_in_executor(executor, timed_call)
+        
+        return await self._with_retries(call)
+    
+    async def stream_response(self, messages, max_tokens=None, cache=False, mode=None):
+        """Stream a response from the xAI API, yielding text as it arrives; raises AIServiceError on failure"""
+        valid_messages = self._clean_messages(messages)
+        
+        if not valid_messages:
+            raise AIServiceError("No valid messages to send to API")
+        
+        # The thread pool path has no streaming, so send the full reply as one chunk
+        if not self.use_async_client:
+            yield await self.generate_response(valid_messages, max_tokens, cache, mode)
+            return
+        
+        models = self.get_mode_models(mode)
+        max_tokens = self._mode_max_tokens(mode, max_tokens)
+        
+        cache_key = None
+        if cache and self.response_cache:
+            cache_key = self.response_cache.make_key(models[0], valid_messages, max_tokens)
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                yield cached
+                return
+        
+        print(f"Streaming {len(valid_messages)} messages to API")
+        
+        timeout = API_SETTINGS.get("timeout", 30)
+        mode = mode or "unknown"
+        started = time.monotonic()
+        # Not made current: a generator can't safely hold a context variable across its yields
+        request_span = self._start_request_span("stream_response", mode, valid_messages)
+        request_span.set(model=models[0])
+        received = []
+        flow, priority = current_request_class()
+        async with self.in_flight.slot(flow, priority):
+            self._record_slot_wait(request_span, priority, started)
+            IN_FLIGHT.inc()
+            try:
+                for index, model in enumerate(models):
+                    try:
+                        async for text in self._stream_chunks(valid_messages, model, max_tokens, timeout):
+                            if not received:
+                                request_span.set(first_chunk_ms=(time.monotonic() - started) * 1000)
+                            received.append(text)
+                            yield text
+                        break
+                    except AIServiceError as e:
+                        # Text already shown can't be taken back, so only fall back before the first chunk
+                        if received or not self._fall_back(mode, models, index, e, request_span):
+                            raise
+            except AIServiceError as e:
+                API_ERRORS.inc(mode)
+                request_span.set(error=repr(e))
+                raise
+            finally:
+                IN_FLIGHT.dec()
+                request_span.set(chunks=len(received))
+                request_span.end()
+        
+        if not received:
+            API_ERRORS.inc(mode)
+            raise AIServiceError("API returned an empty response")
+        response = "".join(received)
+        self._record_request(mode, valid_messages, response, started)
+        if cache_key:
+            self.response_cache.put(cache_key, response)
+    
+    async def _stream_chunks(self, valid_messages, model, max_tokens, timeout):
+        """Open a stream and yield its text chunks"""
+        async def open_stream(backend):
+            return await backend.async_client.chat.completions.create(
+                model=model,
+                messages=valid_messages,
+                max_tokens=max_tokens,
+                stream=True
+            )
+        
+        # Retries only apply to opening the stream; text already shown can't be taken back
+        stream, backend = await self._with_retries(open_stream, hold_backend=True)
+        try:
+            chunks = stream.__aiter__()
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), timeout)
+                except StopAsyncIteration:
+                    break
+                except Exception as e:
+                    backend.record_failure(e)
+                    raise AIServiceError(f"API stream failed: {e!r}") from e
+                
+                if not chunk.choices:
+                    continue
+                text = chunk.choices[0].delta.content
+                if text:
+                    yield text
+        finally:
+            # The backend is busy until the stream ends
+            self._release_backend(backend)
     
     def get_mode_info(self, mode_id):
         """Get information about a specific AI mode"""
@@ -0,0 +1,420 @@
+"""
+Offline load test: drives bot.py with fake Discord objects against a local stand-in AI API
+
+Usage: python benchmark.py --users 50 --messages 20 --latency 0.2 --backend sqlite
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import contextlib
+
+from aiohttp import web
+
+# Fake Discord objects
+
+class FakeUser:
+    """Stands in for discord.User / discord.Member"""
+    
+    def __init__(self, user_id, name=None):
+        self.id = user_id
+        self.name = name or f"user{user_id}"
+        self.display_name = self.name
+        self.mention = f"<@{user_id}>"
+        self.bot = False
+    
+    def __eq__(self, other):
+        return isinstance(other, FakeUser) and other.id == self.id
+    
+    def __hash__(self):
+        return hash(self.id)
+
+class FakeGuild:
+    """Stands in for discord.Guild"""
+    
+    def __init__(self, guild_id):
+        self.id = guild_id
+    
+    def get_channel(self, channel_id):
+        return None
+
+class FakeChannel:
+    """Stands in for a guild text channel"""
+    
+    def __init__(self, channel_id):
+        self.id = channel_id
+        self.mention = f"<#{channel_id}>"
+        self.sent = []
+    
+    def typing(self):
+        return FakeTyping()
+    
+    async def send(self, content=None, **kwargs):
+        # Follow-up parts of replies past Discord's length limit
+        sent = FakeSentMessage(content)
+        self.sent.append(sent)
+        return sent
+
+class FakeTyping:
+    """Async context manager returned by channel.typing()"""
+    
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, *exc_info):
+        return False
+
+class FakeSentMessage:
+    """A reply sent by the bot; edits are recorded so streamed replies can be timed"""
+    
+    def __init__(self, content):
+        self.content = content
+        self.edits = 0
+    
+    async def edit(self, content=None, **kwargs):
+        self.content = content
+        self.edits += 1
+        return self
+
+class FakeMessage:
+    """Stands in for discord.Message; reply() records when the first reply arrived"""
+    
+    def __init__(self, author, channel, content, guild=None, mentions=()):
+        self.author = author
+        self.channel = channel
+        self.content = content
+        self.guild = guild
+        self.mentions = list(mentions)
+        self.sent_at = time.perf_counter()
+        self.replied_at = None
+        self.replies = []
+    
+    async def reply(self, content=None, **kwargs):
+        if self.replied_at is None:
+            self.replied_at = time.perf_counter()
+        sent = FakeSentMessage(content)
+        self.replies.append(sent)
+        return sent
+
+class FakeResponse:
+    """Stands in for interaction.response"""
+    
+    def __init__(self, interaction):
+        self.interaction = interaction
+    
+    async def send_message(self, content=None, **kwargs):
+        self.interaction.responded_at = time.perf_counter()
+        self.interaction.sent = content if content is not None else kwargs.get("embed")
+    
+    async def defer(self, **kwargs):
+        self.interaction.responded_at = time.perf_counter()
+
+class FakeInteraction:
+    """Stands in for discord.Interaction when calling slash command callbacks directly"""
+    
+    def __init__(self, user, guild=None, channel=None):
+        self.user = user
+        self.guild = guild
+        self.channel = channel
+        self.response = FakeResponse(self)
+        self.responded_at = None
+        self.sent = None
+
+# Stand-in OpenAI-compatible API
+
+class FakeAIServer:
+    """Local chat completions server with configurable latency and streaming"""
+    
+    def __init__(self, latency=0.2, jitter=0.05, stream_chunks=10, chunk_delay=0.02, error_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.stream_chunks = stream_chunks
+        self.chunk_delay = chunk_delay
+        self.error_rate = error_rate
+        self.requests = 0
+        self._runner = None
+        self.url = None
+    
+    async def start(self):
+        """Start listening on a free local port"""
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.chat_completions)
+        app.router.add_get("/v1/models", self.models)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        self.url = f"http://127.0.0.1:{port}/v1"
+        return self.url
+    
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+    
+    def _reply_text(self, body):
+        """Build a reply that grows a little with the prompt, like a real model"""
+        words = sum(len(m.get("content", "").split()) for m in body["messages"])
+        return " ".join(["lorem"] * (20 + words % 40))
+    
+    async def models(self, request):
+        return web.json_response({"object": "list", "data": [{"id": "benchmark", "object": "model"}]})
+    
+    async def chat_completions(self, request):
+        body = await request.json()
+        self.requests += 1
+        await asyncio.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+        
+        if random.random() < self.error_rate:
+            return web.json_response({"error": {"message": "overloaded", "type": "server_error"}}, status=503)
+        
+        text = self._reply_text(body)
+        if not body.get("stream"):
+            return web.json_response({
+                "id": "benchmark",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body["model"],
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+            })
+        
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        words = text.split(" ")
+        size = max(1, len(words) // self.stream_chunks)
+        for start in range(0, len(words), size):
+            chunk = {
+                "id": "benchmark",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": body["model"],
+                "choices": [{"index": 0, "delta": {"content": " ".join(words[start:start + size]) + " "}, "finish_reason": None}]
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            await asyncio.sleep(self.chunk_delay)
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+# Measurements
+
+def rss_bytes():
+    """Get the current resident set size, falling back to the peak where /proc isn't available"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kilobytes, macOS bytes
+        return peak if sys.platform == "darwin" else peak * 1024
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))
+    return ordered[index]
+
+def summarize_latencies(values):
+    """Get p50/p95/p99/max in milliseconds"""
+    return {
+        "count": len(values),
+        "p50_ms": percentile(values, 0.50) * 1000,
+        "p95_ms": percentile(values, 0.95) * 1000,
+        "p99_ms": percentile(values, 0.99) * 1000,
+        "max_ms": max(values) * 1000 if values else 0.0
+    }
+
+# Load generation
+
+async def simulate_user(bot_module, bot_user, index, args, results):
+    """One user sending messages in turn, waiting for each reply before the next"""
+    author = FakeUser(10_000 + index)
+    user_id = str(author.id)
+    guild = FakeGuild(1)
+    channel = FakeChannel(100 + index % args.channels)
+    
+    for number in range(args.messages):
+        if args.think_time:
+            await asyncio.sleep(random.uniform(0, args.think_time))
+        content = f"message {number} from {author.name}: " + " ".join(["hello"] * random.randint(5, 40))
+        
+        if args.target == "generate":
+            started = time.perf_counter()
+            await bot_module.generate_ai_response(user_id, content)
+            results["reply"].append(time.perf_counter() - started)
+            results["complete"].append(time.perf_counter() - started)
+        else:
+            mention = random.random() < args.mention_rate
+            if mention:
+                content = f"{bot_user.mention} {content}"
+            message = FakeMessage(author, channel, content, guild=guild, mentions=[bot_user] if mention else [])
+            await bot_module.on_message(message)
+            await bot_module.burst_coalescer.wait_idle(channel.id)
+            await bot_module.turn_queue.wait_idle(user_id)
+            finished = time.perf_counter()
+            auto_reply = bot_module.user_handler.is_channel_enabled(guild.id, channel.id)
+            if message.replied_at is not None:
+                results["reply"].append(message.replied_at - message.sent_at)
+                results["complete"].append(finished - message.sent_at)
+            elif auto_reply and not mention:
+                # Answered by the reply to a later message in the same burst
+                results["batched"] += 1
+            elif mention or auto_reply:
+                results["unanswered"] += 1
+            else:
+                results["ignored"] += 1
+        
+        # Mix in slash commands at the configured rate
+        if random.random() < args.command_rate:
+            await run_command(bot_module, author, guild, channel, results)
+
+async def run_command(bot_module, author, guild, channel, results):
+    """Call a randomly chosen slash command's callback directly"""
+    name = random.choice(["help", "mode", "chathistory", "settings"])
+    command = bot_module.bot.tree.get_command(name)
+    interaction = FakeInteraction(author, guild=guild, channel=channel)
+    started = time.perf_counter()
+    await command.callback(interaction)
+    results["commands"].setdefault(name, []).append(time.perf_counter() - started)
+
+def configure_storage(args, directory):
+    """Point every storage backend at a scratch directory and apply the run's settings before bot.py imports them"""
+    from config import BOT_SETTINGS, STORAGE_SETTINGS, TRACING_SETTINGS, RATE_LIMIT_SETTINGS
+    BOT_SETTINGS["user_data_file"] = os.path.join(directory, "user_data.json")
+    BOT_SETTINGS["stream_responses"] = args.stream
+    STORAGE_SETTINGS["backend"] = args.backend
+    STORAGE_SETTINGS["sqlite_file"] = os.path.join(directory, "user_data.db")
+    STORAGE_SETTINGS["shard_dir"] = os.path.join(directory, "user_data")
+    STORAGE_SETTINGS["journal"] = args.journal
+    STORAGE_SETTINGS["write_behind"] = args.write_behind
+    if not args.rate_limits:
+        # Measure the bot's capacity rather than its overload protection
+        RATE_LIMIT_SETTINGS.update(user_rate=0, guild_rate=0, max_queued_requests=float("inf"), max_queue_age=float("inf"))
+    if args.trace:
+        TRACING_SETTINGS.update(enabled=True, sample_rate=args.trace_sample_rate, file=args.trace)
+
+async def run_benchmark(args):
+    """Start the stand-in API, import the bot against it and run the simulated users"""
+    server = FakeAIServer(args.latency, args.jitter, args.stream_chunks, args.chunk_delay, args.error_rate)
+    api_url = await server.start()
+    os.environ["AI_API_URL"] = api_url
+    os.environ["XAI_API_KEY"] = "benchmark"
+    os.environ["AI_MODEL"] = "benchmark"
+    
+    with tempfile.TemporaryDirectory() as directory:
+        configure_storage(args, directory)
+        
+        # bot.py builds its handlers at import time, so import only once the environment is set
+        import bot as bot_module
+        bot_user = FakeUser(1, "jBot")
+        bot_module.bot._connection.user = bot_user
+        bot_module.user_handler.enable_channel("1", "100")
+        rss_start = rss_bytes()
+        
+        results = {"reply": [], "complete": [], "commands": {}, "unanswered": 0, "batched": 0, "ignored": 0}
+        log = io.StringIO()
+        started = time.perf_counter()
+        # The handlers print a line per request; keep the report readable
+        with contextlib.redirect_stdout(sys.stdout if args.verbose else log):
+            await asyncio.gather(*(
+                simulate_user(bot_module, bot_user, index, args, results) for index in range(args.users)
+            ))
+            elapsed = time.perf_counter() - started
+            
+            save_started = time.perf_counter()
+            bot_module.user_handler.save_data()
+            save_seconds = time.perf_counter() - save_started
+            bot_module.user_handler.close()
+        
+        rss_end = rss_bytes()
+        await server.stop()
+    
+    return {
+        "config": {
+            "target": args.target,
+            "backend": args.backend,
+            "users": args.users,
+            "messages": args.messages,
+            "stream": args.stream,
+            "latency": args.latency
+        },
+        "reply_latency": summarize_latencies(results["reply"]),
+        "complete_latency": summarize_latencies(results["complete"]),
+        "commands": {name: summarize_latencies(values) for name, values in results["commands"].items()},
+        "throughput_per_second": len(results["reply"]) / elapsed if elapsed else 0.0,
+        "elapsed_seconds": elapsed,
+        "api_requests": server.requests,
+        "unanswered": results["unanswered"],
+        "batched": results["batched"],
+        "ignored": results["ignored"],
+        "save_data_ms": save_seconds * 1000,
+        "rss_start_mb": rss_start / 2 ** 20,
+        "rss_end_mb": rss_end / 2 ** 20,
+        "rss_growth_mb": (rss_end - rss_start) / 2 ** 20
+    }
+
+def print_report(report):
+    """Print the benchmark results as a readable table"""
+    config = report["config"]
+    print(f"Target: {config['target']}  backend: {config['backend']}  "
+          f"{config['users']} users x {config['messages']} messages  "
+          f"stream: {config['stream']}  API latency: {config['latency']}s")
+    
+    rows = [("reply", report["reply_latency"]), ("complete", report["complete_latency"])]
+    rows += [(f"/{name}", stats) for name, stats in sorted(report["commands"].items())]
+    print(f"{'':12}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name, stats in rows:
+        print(f"{name:12}{stats['count']:>8}{stats['p50_ms']:>10.1f}{stats['p95_ms']:>10.1f}"
+              f"{stats['p99_ms']:>10.1f}{stats['max_ms']:>10.1f}")
+    
+    print(f"Throughput: {report['throughput_per_second']:.1f} replies/s over {report['elapsed_seconds']:.2f}s "
+          f"({report['api_requests']} API requests, {report['unanswered']} unanswered, "
+          f"{report['batched']} batched, {report['ignored']} ignored)")
+    print(f"save_data: {report['save_data_ms']:.1f} ms")
+    print(f"RSS: {report['rss_start_mb']:.1f} MB -> {report['rss_end_mb']:.1f} MB "
+          f"(+{report['rss_growth_mb']:.1f} MB)")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline load test for the bot")
+    parser.add_argument("--target", choices=("on_message", "generate"), default="on_message",
+                        help="drive the full on_message path or call generate_ai_response directly")
+    parser.add_argument("--users", type=int, default=20, help="simulated users")
+    parser.add_argument("--messages", type=int, default=10, help="messages per user")
+    parser.add_argument("--channels", type=int, default=4, help="guild channels the users spread over; only the first has auto-replies on")
+    parser.add_argument("--mention-rate", type=float, default=0.5, help="share of messages that mention the bot")
+    parser.add_argument("--command-rate", type=float, default=0.1, help="chance of a slash command after each message")
+    parser.add_argument("--think-time", type=float, default=0.0, help="max random pause between a user's messages")
+    parser.add_argument("--backend", choices=("json", "sqlite", "sharded"), default="json")
+    parser.add_argument("--journal", action="store_true", help="use the append-only journal with the JSON backend")
+    parser.add_argument("--write-behind", action="store_true", help="batch storage writes in the background")
+    parser.add_argument("--stream", action=argparse.BooleanOptionalAction, default=True, help="stream replies")
+    parser.add_argument("--latency", type=float, default=0.2, help="mean API latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.05, help="standard deviation of the API latency")
+    parser.add_argument("--stream-chunks", type=int, default=10, help="chunks per streamed reply")
+    parser.add_argument("--chunk-delay", type=float, default=0.02, help="delay between streamed chunks")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of API requests that fail with a 503")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print the report as JSON for comparing runs")
+    parser.add_argument("--rate-limits", action="store_true", help="keep rate limits and load shedding on (off by default)")
+    parser.add_argument("--trace", metavar="FILE", help="write reply traces to this JSONL file")
+    parser.add_argument("--trace-sample-rate", type=float, default=1.0, help="share of replies traced with --trace")
+    parser.add_argument("--verbose", action="store_true", help="show the bot's own log output")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args()
+    random.seed(args.seed)
+    report = asyncio.run(run_benchmark(args))
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
@@ -1,14 +1,28 @@
 import os
+import time
+import signal
+import contextlib
+import asyncio
 import discord
 from discord import app_commands
 from discord.ext import commands
 from dotenv import load_dotenv
 
 # Import custom modules
-from ai_handler import AIHandler
-from user_data_handler import UserDataHandler
+from ai_handler import AIHandler, AIServiceError
+from user_data_handler import create_user_data_handler, run_storage
 from ui_components import ModeSelectView, ChatHistoryView, ClearConfirmView
-from config import BOT_SETTINGS
+from context_builder import PromptBuilder, get_budgets
+from summarizer import ConversationSummarizer
+from request_queue import TurnQueue
+from coalescer import BurstCoalescer
+from rate_limit import RateLimiter
+from scheduler import request_class, INTERACTIVE, AUTO_REPLY, PRIORITY_CLASSES
+from command_sync import sync_commands_if_changed
+from cluster import get_cluster_config, report_health
+from tracing import tracer, span, use_span
+from metrics import REGISTRY, MetricsServer, API_LATENCY, PROMPT_TOKENS, COMPLETION_TOKENS, API_ERRORS, API_RETRIES, IN_FLIGHT, LOOP_LAG, FLUSH_SECONDS, BURST_SIZE, SCHEDULER_WAIT, MESSAGES_SHED
+from config import BOT_SETTINGS, QUEUE_SETTINGS, BURST_SETTINGS, RATE_LIMIT_SETTINGS, METRICS_SETTINGS, CLUSTER_SETTINGS, STORAGE_SETTINGS
 
 # Load environment variables
 load_dotenv()
@@ -16,70 +30,282 @@ load_dotenv()
 # Bot configuration
 DISCORD_TOKEN = os.getenv('DISCORD_TOKEN')
 
+# Set when run_bot.py starts this process as one cluster of a multi-process bot
+cluster = get_cluster_config()
+
 # Bot setup - Use an empty prefix so no prefix commands work
 intents = discord.Intents.default()
 intents.message_content = True
-bot = commands.Bot(command_prefix="", intents=intents)
+if cluster:
+    # This process owns a range of the bot's shards
+    bot = commands.AutoShardedBot(
+        command_prefix="",
+        intents=intents,
+        shard_ids=cluster["shard_ids"],
+        shard_count=cluster["shard_count"]
+    )
+elif CLUSTER_SETTINGS.get("auto_shard", False):
+    bot = commands.AutoShardedBot(command_prefix="", intents=intents, shard_count=CLUSTER_SETTINGS.get("shard_count"))
+else:
+    bot = commands.Bot(command_prefix="", intents=intents)
+
+# Clusters share storage, so only a backend that's safe for concurrent processes will do
+if cluster and STORAGE_SETTINGS.get("backend", "json") != "sqlite":
+    raise RuntimeError("Running as a cluster requires the sqlite storage backend (STORAGE_SETTINGS['backend'])")
 
 # Initialize handlers
 ai_handler = AIHandler()
-user_handler = UserDataHandler()
+user_handler = create_user_data_handler()
+summarizer = ConversationSummarizer(ai_handler, user_handler)
+prompt_builder = PromptBuilder()
 
-async def generate_ai_response(user_id, message_content):
-    """Generate a response from the AI model"""
+# Token buckets for messages per user and per guild, and for slash commands per user
+user_limiter = RateLimiter(RATE_LIMIT_SETTINGS.get("user_rate", 0.5), RATE_LIMIT_SETTINGS.get("user_burst", 8))
+guild_limiter = RateLimiter(RATE_LIMIT_SETTINGS.get("guild_rate", 3.0), RATE_LIMIT_SETTINGS.get("guild_burst", 30))
+# A command cooldown of 0 turns the command limit off, like a rate of 0
+command_cooldown = BOT_SETTINGS.get("command_cooldown", 3)
+command_limiter = RateLimiter(1 / command_cooldown if command_cooldown else 0, RATE_LIMIT_SETTINGS.get("command_burst", 3))
+if cluster:
+    # Each cluster gets its own metrics port and trace file
+    metrics_server = MetricsServer(port=METRICS_SETTINGS.get("port", 9108) + cluster["cluster_id"])
+    tracer.path = f"{tracer.path}.cluster{cluster['cluster_id']}"
+else:
+    metrics_server = MetricsServer()
+health_task = None
+warmup_task = None
+shutdown_task = None
+
+# Discord rejects messages and embed field values longer than these
+MESSAGE_CHAR_LIMIT = 2000
+EMBED_FIELD_LIMIT = 1024
+CODE_FENCE = "```"
+
+def split_message(text, limit=MESSAGE_CHAR_LIMIT):
+    """Split text into Discord-sized parts, breaking at a newline or space where possible
+    
+    A part only depends on the text before its end, so the parts of a growing streamed reply
+    never change once the text has moved past them. Code blocks cut by a split are closed
+    at the end of the part and reopened in the next one.
+    """
+    # Room for closing and reopening a code block
+    window = limit - 2 * (len(CODE_FENCE) + 1)
+    parts = []
+    in_code = False
+    while True:
+        if len(text) <= window:
+            cut = len(text)
+        else:
+            cut = text.rfind("\n", 0, window) + 1
+            if cut < window // 2:
+                cut = text.rfind(" ", 0, window) + 1
+                if cut < window // 2:
+                    cut = window
+        part, text = text[:cut], text[cut:]
+        
+        prefix = f"{CODE_FENCE}\n" if in_code else ""
+        if part.count(CODE_FENCE) % 2:
+            in_code = not in_code
+        suffix = ("" if part.endswith("\n") else "\n") + CODE_FENCE if in_code and text else ""
+        parts.append(prefix + part + suffix)
+        if not text:
+            return parts
+
+async def send_reply(message, text):
+    """Reply with text, continuing in follow-up messages past Discord's length limit"""
+    parts = split_message(text)
+    await message.reply(parts[0])
+    for part in parts[1:]:
+        await message.channel.send(part)
+
+def store_message(user_id, message_content, co_authors):
+    """Store the user's message and read the mode, chat, conversation and summary; runs on the storage thread"""
     # Get user data
-    mode = user_handler.get_current_mode(user_id)
-    conversation = user_handler.get_conversation(user_id)
+    user_data = user_handler.get_user_data(user_id)
+    mode = user_data["current_mode"]
+    chat_id = user_data["current_chat_id"]
     
     # Add user message to conversation
-    user_handler.add_message(user_id, "user", message_content)
-    
-    # Get updated conversation
-    conversation = user_handler.get_conversation(user_id)
-    
-    # Prepare messages for API
-    mode_info = ai_handler.get_mode_info(mode)
-    messages = [{"role": "system", "content": mode_info["system_prompt"]}]
-    messages.extend(conversation)
-    
-    # Call AI API
-    ai_response = await ai_handler.generate_response(messages)
-    
-    # Add AI response to conversation
-    user_handler.add_message(user_id, "assistant", ai_response)
-    
-    return ai_response
+    with span("add_message", role="user", chars=len(message_content)):
+        for author_id in (user_id, *co_authors):
+            user_handler.add_message(author_id, "user", message_content)
+    
+    # Get updated conversation and the summary of its older turns
+    conversation = user_handler.get_conversation(user_id, chat_id)
+    summary = user_handler.get_summary(user_id, chat_id)
+    return mode, chat_id, conversation, summary
+
+async def prepare_ai_request(user_id, message_content, co_authors=()):
+    """Store the user's message and build the messages, output budget, cache flag and mode for the API
+    
+    co_authors are the other people in a multi-author burst; the message is stored in their current chats too.
+    """
+    mode, chat_id, conversation, summary = await run_storage(store_message, user_id, message_content, co_authors)
+    
+    with span("build_context", mode=mode) as context_span:
+        # Extend the chat's prepared messages with the new turns, keeping only the recent ones that fit the mode's budget
+        mode_info = ai_handler.get_mode_info(mode)
+        input_budget, max_tokens = get_budgets(mode_info)
+        messages = prompt_builder.build((user_id, chat_id), mode_info["system_prompt"], conversation, input_budget, summary)
+        context_span.set(stored_messages=len(conversation), message_count=len(messages))
+    return messages, max_tokens, mode_info.get("cache_responses", True), mode
+
+def add_reply(user_ids, response):
+    """Add a reply to the conversation of everyone it answers and get the chats it went to; runs on the storage thread"""
+    with span("add_message", role="assistant", chars=len(response)):
+        for user_id in user_ids:
+            user_handler.add_message(user_id, "assistant", response)
+    return [(user_id, user_handler.get_user_data(user_id)["current_chat_id"]) for user_id in user_ids]
+
+async def store_reply(user_ids, response):
+    """Store a reply and restart the summary timer of every chat it went to"""
+    for user_id, chat_id in await run_storage(add_reply, user_ids, response):
+        summarizer.schedule(user_id, chat_id)
+
+async def generate_ai_response(user_id, message_content, co_authors=()):
+    """Generate a response from the AI model"""
+    with span("generate_ai_response", user=user_id) as response_span:
+        messages, max_tokens, cache, mode = await prepare_ai_request(user_id, message_content, co_authors)
+        response_span.set(mode=mode)
+        
+        # Call AI API; failures are shown to the user but never stored in the conversation
+        try:
+            ai_response = await ai_handler.generate_response(messages, max_tokens, cache, mode)
+        except AIServiceError as e:
+            print(f"AI request failed for user {user_id}: {e}")
+            response_span.set(error=str(e))
+            return e.user_message
+        
+        # Add AI response to conversation
+        await store_reply((user_id, *co_authors), ai_response)
+        return ai_response
+
+async def stream_ai_response(message, user_id, message_content, co_authors=()):
+    """Reply as soon as the first text arrives and keep editing the reply as the rest streams in"""
+    with span("stream_ai_response", user=user_id) as stream_span:
+        messages, max_tokens, cache, mode = await prepare_ai_request(user_id, message_content, co_authors)
+        stream_span.set(mode=mode)
+        loop = asyncio.get_running_loop()
+        interval = BOT_SETTINGS.get("stream_edit_interval", 1.0)
+        
+        response = ""
+        # Messages showing the reply so far, and the text in each; replies past the length limit continue in new messages
+        replies = []
+        shown_parts = []
+        edits = 0
+        edit_time = 0.0
+        
+        async def show(text):
+            nonlocal edits, edit_time
+            edit_started = loop.time()
+            for index, part in enumerate(split_message(text)):
+                if index == len(replies):
+                    send = message.reply if not replies else message.channel.send
+                    replies.append(await send(part))
+                    shown_parts.append(part)
+                elif shown_parts[index] != part:
+                    await replies[index].edit(content=part)
+                    shown_parts[index] = part
+                    edits += 1
+            # Time spent sending and editing, including any wait on Discord's rate limits
+            edit_time += loop.time() - edit_started
+        
+        # Close the stream even when the reply fails part way, so its connection is released
+        async with contextlib.aclosing(ai_handler.stream_response(messages, max_tokens, cache, mode)) as chunks:
+            try:
+                # Show typing indicator until the first visible text arrives
+                async with message.channel.typing():
+                    async for chunk in chunks:
+                        response += chunk
+                        if response.strip():
+                            break
+                if not response.strip():
+                    raise AIServiceError("API returned an empty response")
+                
+                with span("discord_reply"):
+                    await show(response)
+                shown = response
+                last_edit = loop.time()
+                
+                # Edit at a fixed interval to stay clear of Discord's rate limits
+                async for chunk in chunks:
+                    response += chunk
+                    if loop.time() - last_edit >= interval:
+                        await show(response)
+                        shown = response
+                        last_edit = loop.time()
+                
+                if response != shown:
+                    await show(response)
+            except AIServiceError as e:
+                # Show what went wrong, but keep partial or error text out of the conversation
+                print(f"AI stream failed for user {user_id}: {e}")
+                stream_span.set(error=str(e))
+                if replies:
+                    await show(f"{response}\n\n*(Response interrupted. {e.user_message})*")
+                else:
+                    await message.reply(e.user_message)
+                return None
+            finally:
+                stream_span.set(edits=edits, edit_ms=edit_time * 1000, response_chars=len(response))
+        
+        # Add the complete AI response to conversation
+        await store_reply((user_id, *co_authors), response)
+        return response
+
+async def warm_up_api():
+    """Pre-warm API connections, logging instead of raising if that fails"""
+    try:
+        await ai_handler.warmup()
+    except Exception as e:
+        print(f"Connection pre-warming failed: {e}")
 
 # Bot events
+@bot.event
+async def setup_hook():
+    """Called once after login, before connecting to the gateway; reconnects don't run it again"""
+    # Open API connections in the background, so connecting to Discord doesn't wait on the API
+    global warmup_task
+    warmup_task = asyncio.create_task(warm_up_api())
+    
+    # Close cleanly on SIGTERM/SIGINT so writes held back by the storage layer are flushed
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, request_shutdown)
+        except NotImplementedError:
+            pass  # Signal handlers aren't available on Windows event loops
+    
+    # Start the loop lag probe, and the HTTP endpoint if enabled
+    await metrics_server.start(serve_http=METRICS_SETTINGS.get("enabled", False))
+    
+    # Register commands only when their definitions changed, so restarts don't re-sync
+    # Commands are global, so in a cluster only the first process syncs them
+    if not cluster or cluster["cluster_id"] == 0:
+        try:
+            await sync_commands_if_changed(bot.tree, bot.application_id, force=BOT_SETTINGS.get("force_command_sync", False))
+        except Exception as e:
+            print(f"Error registering commands: {e}")
+    
+    # Report this cluster's shards and load to the launcher
+    global health_task
+    if cluster and not health_task:
+        health_task = asyncio.create_task(report_health(bot, cluster, cluster_load))
+
+def request_shutdown():
+    """Close the bot from a signal handler; bot.run then returns and the storage is flushed"""
+    global shutdown_task
+    if not shutdown_task:
+        shutdown_task = asyncio.create_task(bot.close())
+
 @bot.event
 async def on_ready():
-    """Called when the bot is ready"""
+    """Called when the bot is ready, including after every reconnect"""
     print(f'{bot.user} has connected to Discord!')
     
-    # Register commands on startup
-    print("Registering application (/) commands...")
-    
-    try:
-        # Clear existing commands to avoid issues
-        if bot.application_id:
-            # This is a direct approach that always works
-            await bot.http.bulk_upsert_global_commands(bot.application_id, [])
-            print("Cleared existing commands.")
-        
-        # Now register the commands to Discord
-        # This approach directly registers the commands with Discord API
-        synced = await bot.tree.sync()
-        
-        # Show the registered commands
-        command_names = [cmd.name for cmd in synced]
-        print(f"Successfully registered {len(synced)} commands: {', '.join(command_names)}")
-        
-        # Show invite link in case the bot needs to be reinvited
-        if hasattr(bot, 'application_id') and bot.application_id:
-            print(f"If commands don't appear, use this invite link:")
-            print(f"https://discord.com/api/oauth2/authorize?client_id={bot.application_id}&permissions=274878024704&scope=bot%20applications.commands")
-    except Exception as e:
-        print(f"Error registering commands: {e}")
+    # Show invite link in case the bot needs to be reinvited
+    if bot.application_id:
+        print(f"If commands don't appear, use this invite link:")
+        print(f"https://discord.com/api/oauth2/authorize?client_id={bot.application_id}&permissions=274878024704&scope=bot%20applications.commands")
 
 @bot.event
 async def on_message(message):
@@ -92,13 +318,8 @@ async def on_message(message):
     is_dm = isinstance(message.channel, discord.DMChannel)
     is_mentioned = bot.user in message.mentions
     
-    # Check if this is an enabled channel for this guild
-    is_enabled_channel = False
-    if message.guild:
-        guild_id = str(message.guild.id)
-        channel_id = str(message.channel.id)
-        guild_data = user_handler.get_guild_data(guild_id)
-        is_enabled_channel = channel_id in guild_data.get("enabled_channels", [])
+    # Most guild traffic is ignored, so check enabled channels in memory without touching storage
+    is_enabled_channel = bool(message.guild) and user_handler.is_channel_enabled(message.guild.id, message.channel.id)
     
     if is_dm or is_mentioned or is_enabled_channel:
         # Remove mention from message content if present
@@ -106,17 +327,164 @@ async def on_message(message):
         if is_mentioned:
             content = content.replace(f'<@{bot.user.id}>', '').strip()
         
-        # Only proceed if there's content
+        # Only proceed if there's content; each user's turns are answered one at a time
         if content:
+            # Turn the message away if its sender or guild is over their limit or the bot is overloaded
+            notice = admit_message(message, INTERACTIVE if is_dm or is_mentioned else AUTO_REPLY)
+            if notice is not None:
+                if notice:
+                    await message.reply(notice)
+                return
+            
+            # The trace covers the reply from the gateway event until it's sent
+            trace = tracer.start_trace(
+                "reply",
+                user=str(message.author.id),
+                source="dm" if is_dm else "mention" if is_mentioned else "auto_reply",
+                chars=len(content)
+            )
+            if is_dm or is_mentioned:
+                turn_queue.submit(str(message.author.id), (message, content, trace, ()))
+            else:
+                # Auto-reply chatter from several people at once is gathered into bursts that get one reply
+                window = user_handler.get_guild_setting(message.guild.id, "burst_window", BURST_SETTINGS.get("window", 3.0))
+                burst_coalescer.add(message.channel.id, (message, content, trace), window, message.author.id)
+
+def rate_limit_notice(bucket, interactive):
+    """Tell a DM or mention sender once that they're limited; auto-reply messages are dropped silently"""
+    if not interactive or bucket.warned:
+        return ""
+    bucket.warned = True
+    return RATE_LIMIT_SETTINGS.get("rate_limited_message", "").format(seconds=max(1, round(bucket.retry_after())))
+
+def admit_message(message, priority):
+    """Check rate limits and load; returns None to accept the message, or the notice to reply with ("" for none)"""
+    interactive = priority == INTERACTIVE
+    
+    allowed, bucket = user_limiter.take(message.author.id)
+    if not allowed:
+        MESSAGES_SHED.inc("user_rate")
+        return rate_limit_notice(bucket, interactive)
+    if message.guild:
+        allowed, bucket = guild_limiter.take(message.guild.id)
+        if not allowed:
+            MESSAGES_SHED.inc("guild_rate")
+            return rate_limit_notice(bucket, interactive)
+    
+    # Only requests that would be served before this one count, so DMs and mentions aren't shed for auto-reply backlog
+    queued, oldest_wait = ai_handler.in_flight.backlog(priority)
+    if queued >= RATE_LIMIT_SETTINGS.get("max_queued_requests", 64) or oldest_wait >= RATE_LIMIT_SETTINGS.get("max_queue_age", 20):
+        MESSAGES_SHED.inc("overload")
+        return RATE_LIMIT_SETTINGS.get("busy_message", "") if interactive else ""
+    return None
+
+async def check_command_rate(interaction: discord.Interaction):
+    """Enforce the per-user slash command rate before any command runs"""
+    allowed, bucket = command_limiter.take(interaction.user.id)
+    if allowed:
+        return True
+    MESSAGES_SHED.inc("command_rate")
+    await interaction.response.send_message(
+        f"Please wait {max(1, round(bucket.retry_after()))} seconds before using another command.",
+        ephemeral=True
+    )
+    return False
+
+# Runs for every slash command, before its own checks
+bot.tree.interaction_check = check_command_rate
+
+# Auto-reply channel ID -> turns being answered there, so new messages in busy channels are gathered into bursts
+replying_channels = {}
+
+async def process_turn(user_id, batch):
+    """Answer one turn, made of one message or several merged messages from the same channel
+    
+    Items are (message, content, trace, co_authors); co_authors are the other people a burst's reply answers.
+    """
+    message, _, trace, _ = batch[-1]
+    content = "\n\n".join(item[1] for item in batch)
+    co_authors = tuple(dict.fromkeys(author_id for item in batch for author_id in item[3] if author_id != user_id))
+    
+    # Merged messages are answered under the last message's trace
+    for _, _, merged_trace, _ in batch[:-1]:
+        merged_trace.set(merged=True)
+        merged_trace.end()
+    if trace.sampled:
+        trace.set(queue_wait_ms=(time.time_ns() - trace.start) / 1e6, merged_messages=len(batch))
+    
+    # DMs and mentions are served ahead of auto-reply traffic; guilds share API slots by weight
+    interactive = message.guild is None or bot.user in message.mentions
+    flow = message.guild.id if message.guild else f"dm_{message.author.id}"
+    
+    channel_id = message.channel.id
+    replying_channels[channel_id] = replying_channels.get(channel_id, 0) + 1
+    try:
+        with use_span(trace), request_class(flow, INTERACTIVE if interactive else AUTO_REPLY):
+            if BOT_SETTINGS.get("stream_responses", False):
+                await stream_ai_response(message, user_id, content, co_authors)
+                return
+            
             # Show typing indicator
             async with message.channel.typing():
                 # Generate AI response
-                response = await generate_ai_response(str(message.author.id), content)
+                response = await generate_ai_response(user_id, content, co_authors)
             
             # Send response
             if not response or not response.strip():
                 response = "Sorry, I couldn't generate a response at this time."
-            await message.reply(response)
+            with span("discord_reply"):
+                await send_reply(message, response)
+    finally:
+        replying_channels[channel_id] -= 1
+        if not replying_channels[channel_id]:
+            del replying_channels[channel_id]
+
+def can_merge_turns(first, item):
+    """Messages sent while a turn is in flight join the next turn if they're in the same channel"""
+    return QUEUE_SETTINGS.get("merge_pending_messages", True) and first[0].channel.id == item[0].channel.id
+
+turn_queue = TurnQueue(process_turn, can_merge_turns)
+
+def dispatch_burst(channel_id, batch):
+    """Queue a burst from an auto-reply channel as one turn"""
+    BURST_SIZE.observe(len(batch))
+    message, _, trace = batch[-1]
+    for _, _, merged_trace in batch[:-1]:
+        merged_trace.set(merged=True)
+        merged_trace.end()
+    
+    authors = list(dict.fromkeys(str(item_message.author.id) for item_message, _, _ in batch))
+    if len(authors) == 1:
+        # One person's messages are their own turn, as if sent in a DM
+        content = "\n\n".join(item_content for _, item_content, _ in batch)
+        turn_queue.submit(authors[0], (message, content, trace, ()))
+        return
+    
+    # Several people talking at once get one reply, with each line attributed. It is generated in the last
+    # author's chat and mode, and the exchange is stored in every author's own current chat
+    content = "\n".join(
+        f"{item_message.author.display_name}: {item_content}" for item_message, item_content, _ in batch
+    )
+    trace.set(burst_authors=len(authors), burst_messages=len(batch))
+    last_author = str(message.author.id)
+    turn_queue.submit(last_author, (message, content, trace, [author for author in authors if author != last_author]))
+
+burst_coalescer = BurstCoalescer(dispatch_burst, is_busy=lambda channel_id: channel_id in replying_channels)
+
+def cluster_load():
+    """Load figures included in this cluster's health report"""
+    return {
+        "queue_depth": turn_queue.depth(),
+        "slot_queue_depth": ai_handler.in_flight.queued(),
+        "in_flight_requests": IN_FLIGHT.get(),
+        "loop_lag_ms": LOOP_LAG.get() * 1000
+    }
+
+# Values read from other components when metrics are scraped
+QUEUE_DEPTH = REGISTRY.gauge("jbot_turn_queue_depth", "Messages waiting for their user's turn", callback=turn_queue.depth)
+SLOT_QUEUE = REGISTRY.gauge("jbot_api_slot_queue_depth", "AI requests waiting for an API slot", callback=ai_handler.in_flight.queued)
+BURST_PENDING = REGISTRY.gauge("jbot_auto_reply_pending_messages", "Auto-reply messages waiting for their burst to close", callback=burst_coalescer.pending)
+DATA_SIZE = REGISTRY.gauge("jbot_user_data_bytes", "Size of stored user data", callback=user_handler.data_size)
 
 # Bot slash commands
 @bot.tree.command(name="help", description="Display all available commands")
@@ -135,6 +503,7 @@ async def help_command(interaction: discord.Interaction):
     embed.add_field(name="/settings", value="Configure the AI assistant settings", inline=False)
     embed.add_field(name="/clear", value="Clear your current conversation history", inline=False)
     embed.add_field(name="/autoreply", value="Toggle AI auto-responses in a specific channel", inline=False)
+    embed.add_field(name="/stats", value="Show bot performance statistics (administrators only)", inline=False)
     
     # Add usage information
     embed.add_field(
@@ -143,6 +512,7 @@ async def help_command(interaction: discord.Interaction):
               "1. Use `/autoreply channel:#channel-name` to enable auto-responses in a channel\n"
               "2. The bot will then respond to all messages in that channel\n"
               "3. Use `/autoreply channel:#channel-name enable:False` to turn this feature off\n"
+              "4. Busy channels get one reply per burst of messages; set the wait with `batch_window`\n"
               "Note: You need 'Manage Channels' permission to use this command",
         inline=False
     )
@@ -153,7 +523,7 @@ async def help_command(interaction: discord.Interaction):
 async def mode_command(interaction: discord.Interaction):
     """Display available AI modes and allow selection"""
     user_id = str(interaction.user.id)
-    current_mode = user_handler.get_current_mode(user_id)
+    current_mode = await run_storage(user_handler.get_current_mode, user_id)
     all_modes = ai_handler.get_all_modes()
     mode_info = ai_handler.get_mode_info(current_mode)
     
@@ -183,7 +553,7 @@ async def newchat_command(interaction: discord.Interaction, name: str = None):
     user_id = str(interaction.user.id)
     
     # Create new chat
-    chat_id, chat_name = user_handler.create_new_chat(user_id, name)
+    chat_id, chat_name = await run_storage(user_handler.create_new_chat, user_id, name)
     
     await interaction.response.send_message(
         f"Started a new chat: **{chat_name}**\nYou can now continue your conversation with a fresh memory.",
@@ -195,38 +565,19 @@ async def chathistory_command(interaction: discord.Interaction):
     """Display chat history and allow selection"""
     user_id = str(interaction.user.id)
     
-    # Get chat history
-    chats = user_handler.get_chat_history(user_id)
+    # Only the first page of the chat index is read here; the view fetches the others on demand
+    view = ChatHistoryView(user_handler, user_id, BOT_SETTINGS.get("chat_history_page_size", 10))
     
-    # Create embed
-    embed = discord.Embed(
-        title="Your Chat History",
-        description="Select a chat to continue the conversation:",
-        color=discord.Color.gold()
-    )
-    
-    if not chats:
-        embed.description = "You don't have any previous chats. Use /newchat to start one!"
+    if not view.total:
+        embed = discord.Embed(
+            title="Your Chat History",
+            description="You don't have any previous chats. Use /newchat to start one!",
+            color=discord.Color.gold()
+        )
         await interaction.response.send_message(embed=embed, ephemeral=True)
         return
     
-    # Get current chat ID
-    user_data = user_handler.get_user_data(user_id)
-    current_chat_id = user_data["current_chat_id"]
-    
-    # Add fields for each chat
-    for chat_id, name, message_count in chats:
-        is_current = chat_id == current_chat_id
-        embed.add_field(
-            name=f"{name} {'(Current)' if is_current else ''}",
-            value=f"{message_count} messages",
-            inline=False
-        )
-    
-    # Create chat selection view
-    view = ChatHistoryView(chats, user_handler)
-    
-    await interaction.response.send_message(embed=embed, view=view, ephemeral=True)
+    await interaction.response.send_message(embed=view.make_embed(), view=view, ephemeral=True)
 
 @bot.tree.command(name="clear", description="Clear your current conversation history")
 async def clear_command(interaction: discord.Interaction):
@@ -255,7 +606,8 @@ async def settings_command(interaction: discord.Interaction):
         name="API Configuration",
         value="The AI API is currently configured with the following settings:\n"
               f"- API URL: `{ai_handler.api_url if ai_handler.api_url else 'Not configured'}`\n"
-              f"- API Token: `{'Configured' if ai_handler.api_token else 'Not configured'}`\n\n"
+              f"- API Token: `{'Configured' if ai_handler.api_token else 'Not configured'}`\n"
+              f"- Backends: `{len(ai_handler.backends)}`\n\n"
               "To change these settings, update your .env file and restart the bot.",
         inline=False
     )
@@ -270,7 +622,7 @@ async def settings_command(interaction: discord.Interaction):
     # Add guild-specific settings if in a guild
     if interaction.guild:
         guild_id = str(interaction.guild.id)
-        guild_data = user_handler.get_guild_data(guild_id)
+        guild_data = await run_storage(user_handler.get_guild_data, guild_id)
         enabled_channels = guild_data.get("enabled_channels", [])
         
         if enabled_channels:
@@ -281,10 +633,12 @@ async def settings_command(interaction: discord.Interaction):
                     channel_mentions.append(channel.mention)
             
             if channel_mentions:
+                window = user_handler.get_guild_setting(interaction.guild.id, "burst_window", BURST_SETTINGS.get("window", 3.0))
                 embed.add_field(
                     name="Auto-Reply Channels",
                     value="The bot will automatically respond to all messages in these channels:\n• " + 
                           "\n• ".join(channel_mentions) + 
+                          (f"\n\nBursts of messages within `{window:g}s` get one reply." if window else "") +
                           f"\n\nUse `/autoreply` to manage auto-reply channels.",
                     inline=False
                 )
@@ -301,16 +655,27 @@ async def settings_command(interaction: discord.Interaction):
 @bot.tree.command(name="autoreply", description="Toggle AI auto-responses in a specific channel")
 @app_commands.guild_only()
 @app_commands.checks.has_permissions(manage_channels=True)
-@app_commands.describe(channel="The channel to enable/disable auto-responses in", enable="Enable or disable auto-responses (default: toggle)")
-async def autoreply_command(interaction: discord.Interaction, channel: discord.TextChannel, enable: bool = None):
+@app_commands.describe(
+    channel="The channel to enable/disable auto-responses in",
+    enable="Enable or disable auto-responses (default: toggle)",
+    batch_window="Seconds to gather a burst of messages into one reply, for every channel in this server (0 = off)"
+)
+async def autoreply_command(
+    interaction: discord.Interaction,
+    channel: discord.TextChannel,
+    enable: bool = None,
+    batch_window: app_commands.Range[float, 0.0, float(BURST_SETTINGS.get("max_window", 30.0))] = None
+):
     """Toggle automatic AI responses in a specific channel"""
     # Guild-only check is handled by the decorator
     guild_id = str(interaction.guild.id)
     channel_id = str(channel.id)
     
+    if batch_window is not None:
+        await run_storage(user_handler.set_guild_setting, guild_id, "burst_window", batch_window)
+    
     # Get current channel status
-    guild_data = user_handler.get_guild_data(guild_id)
-    is_enabled = channel_id in guild_data.get("enabled_channels", [])
+    is_enabled = user_handler.is_channel_enabled(interaction.guild.id, channel.id)
     
     # Determine whether to enable or disable
     if enable is None:
@@ -321,14 +686,14 @@ async def autoreply_command(interaction: discord.Interaction, channel: discord.T
     if enable:
         # Enable the channel if not already enabled
         if not is_enabled:
-            user_handler.enable_channel(guild_id, channel_id)
+            await run_storage(user_handler.enable_channel, guild_id, channel_id)
             status = "enabled"
         else:
             status = "already enabled"
     else:
         # Disable the channel if currently enabled
         if is_enabled:
-            user_handler.disable_channel(guild_id, channel_id)
+            await run_storage(user_handler.disable_channel, guild_id, channel_id)
             status = "disabled"
         else:
             status = "already disabled"
@@ -347,9 +712,95 @@ async def autoreply_command(interaction: discord.Interaction, channel: discord.T
             value="The bot will now respond to all messages in this channel without being mentioned.",
             inline=False
         )
+    if batch_window is not None:
+        embed.add_field(
+            name="Burst Batching",
+            value=f"Messages sent within `{batch_window:g}s` of each other in busy auto-reply channels now get one reply."
+                  if batch_window else "Every auto-reply message now gets its own reply.",
+            inline=False
+        )
+    
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+def add_lines_field(embed, name, lines):
+    """Add lines as an embed field, continuing in more fields past Discord's field length limit"""
+    value = ""
+    field_name = name
+    for line in lines:
+        line = line[:EMBED_FIELD_LIMIT]
+        if value and len(value) + 1 + len(line) > EMBED_FIELD_LIMIT:
+            embed.add_field(name=field_name, value=value, inline=False)
+            field_name = f"{name} (continued)"
+            value = ""
+        value = f"{value}\n{line}" if value else line
+    embed.add_field(name=field_name, value=value, inline=False)
+
+@bot.tree.command(name="stats", description="Show bot performance statistics (admin only)")
+@app_commands.guild_only()
+@app_commands.default_permissions(administrator=True)
+@app_commands.checks.has_permissions(administrator=True)
+async def stats_command(interaction: discord.Interaction):
+    """Show API latency, token usage, errors and storage statistics"""
+    embed = discord.Embed(
+        title="Bot Statistics",
+        color=discord.Color.dark_teal()
+    )
+    
+    # Per-mode API latency and token usage
+    for (mode,) in API_LATENCY.values:
+        p50 = API_LATENCY.quantile(0.5, mode)
+        p95 = API_LATENCY.quantile(0.95, mode)
+        embed.add_field(
+            name=ai_handler.get_all_modes().get(mode, {}).get("name", mode),
+            value=f"- Requests: `{API_LATENCY.count(mode)}`\n"
+                  f"- Latency p50/p95: `{p50:.2f}s` / `{p95:.2f}s`\n"
+                  f"- Tokens in/out p50: `{PROMPT_TOKENS.quantile(0.5, mode):.0f}` / `{COMPLETION_TOKENS.quantile(0.5, mode):.0f}`",
+            inline=False
+        )
+    
+    api_lines = [
+        f"- In flight: `{IN_FLIGHT.get()}` (`{ai_handler.in_flight.queued()}` waiting for a slot)",
+        f"- Errors: `{API_ERRORS.total()}`",
+        f"- Retries: `{API_RETRIES.total()}`"
+    ]
+    api_lines += [
+        f"- Slot wait p95 ({priority.replace('_', ' ')}): `{SCHEDULER_WAIT.quantile(0.95, priority) * 1000:.0f} ms`"
+        for priority in PRIORITY_CLASSES if SCHEDULER_WAIT.count(priority)
+    ]
+    api_lines += [
+        f"- Backend {backend.name}: `{backend.state}`, "
+        f"`{f'{backend.latency * 1000:.0f} ms' if backend.latency is not None else 'no data'}`, "
+        f"`{backend.outstanding}/{backend.max_concurrency}` busy"
+        for backend in ai_handler.backends
+    ]
+    add_lines_field(embed, "API", api_lines)
+    
+    cache_line = ""
+    if ai_handler.response_cache:
+        cache_stats = ai_handler.response_cache.stats()
+        cache_line = f"\n- Response cache: `{cache_stats['entries']}` entries, `{cache_stats['hit_rate']:.0%}` hit rate"
+    embed.add_field(
+        name="Bot",
+        value=f"- Queued messages: `{turn_queue.depth()}`\n"
+              f"- Turned away (rate limits and overload): `{MESSAGES_SHED.total()}`\n"
+              f"- Event loop lag: `{LOOP_LAG.get() * 1000:.1f} ms`\n"
+              f"- Gateway latency: `{bot.latency * 1000:.0f} ms`" + cache_line,
+        inline=False
+    )
+    
+    embed.add_field(
+        name="Storage",
+        value=f"- User data size: `{user_handler.data_size() / 1024:.1f} KiB`\n"
+              f"- Last flush: `{FLUSH_SECONDS.get() * 1000:.1f} ms`",
+        inline=False
+    )
     
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
 # Run the bot
 if __name__ == "__main__":
-    bot.run(DISCORD_TOKEN)
+    try:
+        bot.run(DISCORD_TOKEN)
+    finally:
+        # Write out any changes still held back by the storage layer
+        user_handler.close()
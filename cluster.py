@@ -0,0 +1,88 @@
+"""
+Shard planning and health reporting for running the bot as several processes
+"""
+
+import os
+import json
+import math
+import time
+import asyncio
+
+from config import CLUSTER_SETTINGS
+
+# Set by the cluster launcher in run_bot.py for each worker process
+CLUSTER_ID_ENV = "JBOT_CLUSTER_ID"
+SHARD_IDS_ENV = "JBOT_SHARD_IDS"
+SHARD_COUNT_ENV = "JBOT_SHARD_COUNT"
+
+def get_cluster_config():
+    """Get this process's cluster ID, shard IDs and total shard count, or None outside a cluster"""
+    if CLUSTER_ID_ENV not in os.environ:
+        return None
+    return {
+        "cluster_id": int(os.environ[CLUSTER_ID_ENV]),
+        "shard_ids": [int(shard_id) for shard_id in os.environ[SHARD_IDS_ENV].split(",")],
+        "shard_count": int(os.environ[SHARD_COUNT_ENV])
+    }
+
+def plan_clusters(shard_count, clusters):
+    """Split shards into contiguous ranges, one per cluster, as evenly as possible"""
+    clusters = max(1, min(clusters, shard_count))
+    size, extra = divmod(shard_count, clusters)
+    plan = []
+    start = 0
+    for cluster_id in range(clusters):
+        end = start + size + (1 if cluster_id < extra else 0)
+        plan.append(list(range(start, end)))
+        start = end
+    return plan
+
+def health_path(cluster_id, directory=None):
+    directory = directory or CLUSTER_SETTINGS.get("health_dir", "cluster_health")
+    return os.path.join(directory, f"cluster-{cluster_id}.json")
+
+def build_health_report(bot, cluster, extra=None):
+    """Describe a running cluster: its shards' connection state and latency, guilds and load"""
+    shards = {}
+    for shard_id, shard in getattr(bot, "shards", {}).items():
+        shards[str(shard_id)] = {
+            "latency_ms": round(shard.latency * 1000, 1) if math.isfinite(shard.latency) else None,
+            "closed": shard.is_closed()
+        }
+    return {
+        "cluster_id": cluster["cluster_id"],
+        "pid": os.getpid(),
+        "shard_ids": cluster["shard_ids"],
+        "shards": shards,
+        "guilds": len(bot.guilds),
+        "ready": bot.is_ready(),
+        "updated_at": time.time(),
+        **(extra() if extra else {})
+    }
+
+def write_health(report, path):
+    """Atomically replace a cluster's health file"""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(report, f)
+    os.replace(tmp_path, path)
+
+async def report_health(bot, cluster, extra=None, interval=None):
+    """Write this cluster's health report periodically for the launcher to read"""
+    interval = interval or CLUSTER_SETTINGS.get("health_interval", 15)
+    path = health_path(cluster["cluster_id"])
+    while True:
+        try:
+            write_health(build_health_report(bot, cluster, extra), path)
+        except Exception as e:
+            print(f"Error writing cluster health: {str(e)}")
+        await asyncio.sleep(interval)
+
+def read_health(cluster_id, directory=None):
+    """Read a cluster's last health report, or None if it hasn't written one"""
+    try:
+        with open(health_path(cluster_id, directory), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
@@ -0,0 +1,109 @@
+"""
+Batching of message bursts in auto-reply channels into one reply
+"""
+
+import math
+import time
+import asyncio
+
+from config import BURST_SETTINGS
+
+class _Burst:
+    """Messages gathered so far in one channel"""
+    __slots__ = ("items", "started", "timer", "dispatched")
+    
+    def __init__(self, started):
+        self.items = []
+        self.started = started
+        self.timer = None
+        self.dispatched = asyncio.get_running_loop().create_future()
+
+class BurstCoalescer:
+    """Gathers messages that arrive close together in a channel and hands them on as one batch
+    
+    A batch only opens when the channel has concurrent traffic: another author posted within
+    the window, or a reply for the channel is still being generated. One person chatting on
+    their own is answered right away.
+    """
+    
+    def __init__(self, dispatch, is_busy=None, max_batch=None, smoothing=None):
+        """dispatch(channel_id, items) receives each finished batch; is_busy(channel_id) tells whether a reply is in progress there"""
+        self.dispatch = dispatch
+        self.is_busy = is_busy or (lambda channel_id: False)
+        self.max_batch_cap = max_batch or BURST_SETTINGS.get("max_batch", 20)
+        self.smoothing = smoothing or BURST_SETTINGS.get("rate_smoothing", 0.3)
+        # channel_id -> (average seconds between messages, time of the last message, its author)
+        self._gaps = {}
+        # channel_id -> burst waiting to be dispatched
+        self._bursts = {}
+    
+    def _observe(self, channel_id, now, window, author):
+        """Update the channel's average gap between messages; returns it and whether another author posted within the window"""
+        average, last, last_author = self._gaps.get(channel_id, (math.inf, None, None))
+        crowded = False
+        if last is not None:
+            crowded = last_author != author and now - last < window
+            # Cap single gaps so a channel waking up from a long silence adapts within a few messages
+            gap = min(now - last, 2 * window)
+            average = gap if math.isinf(average) else self.smoothing * gap + (1 - self.smoothing) * average
+        self._gaps[channel_id] = (average, now, author)
+        return average, crowded
+    
+    def window_for(self, gap, window):
+        """Wait a little longer than the usual gap in busy channels, and not at all in quiet ones"""
+        if gap >= window:
+            return 0.0
+        return min(window, 1.5 * gap)
+    
+    def max_batch_for(self, gap, window):
+        """Allow about as many messages as a busy channel sends in two windows"""
+        if gap <= 0:
+            return self.max_batch_cap
+        return max(2, min(self.max_batch_cap, math.ceil(2 * window / gap)))
+    
+    def add(self, channel_id, item, window, author=None):
+        """Queue an item for its channel's next batch; window is the longest a batch may wait"""
+        now = time.monotonic()
+        gap, crowded = self._observe(channel_id, now, window, author)
+        wait = self.window_for(gap, window) if window > 0 else 0.0
+        
+        burst = self._bursts.get(channel_id)
+        if burst is None:
+            # Holding back a lone author's message would only add latency
+            if wait <= 0 or not (crowded or self.is_busy(channel_id)):
+                self.dispatch(channel_id, [item])
+                return
+            burst = self._bursts[channel_id] = _Burst(now)
+        burst.items.append(item)
+        
+        if len(burst.items) >= self.max_batch_for(gap, window):
+            self.flush(channel_id)
+            return
+        
+        # Each message restarts the wait, but a batch never waits longer than the window in total
+        if burst.timer:
+            burst.timer.cancel()
+        delay = max(0.0, min(wait, burst.started + window - now))
+        burst.timer = asyncio.get_running_loop().call_later(delay, self.flush, channel_id)
+    
+    def flush(self, channel_id):
+        """Dispatch a channel's gathered messages now"""
+        burst = self._bursts.pop(channel_id, None)
+        if burst is None:
+            return
+        if burst.timer:
+            burst.timer.cancel()
+        try:
+            self.dispatch(channel_id, burst.items)
+        finally:
+            burst.dispatched.set_result(None)
+    
+    async def wait_idle(self, channel_id):
+        """Wait until a channel's gathered messages have been dispatched"""
+        burst = self._bursts.get(channel_id)
+        if burst:
+            await asyncio.shield(burst.dispatched)
+    
+    def pending(self):
+        """Get the number of messages waiting in unfinished batches"""
+        return sum(len(burst.items) for burst in self._bursts.values())
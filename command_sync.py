@@ -0,0 +1,102 @@
+"""
+Sync slash commands with Discord only when their definitions changed
+"""
+
+import os
+import json
+import hashlib
+
+from config import BOT_SETTINGS
+
+def _normalize_option(option):
+    """Reduce an option to the fields that affect how Discord shows it, with defaults filled in"""
+    return {
+        "name": option["name"],
+        "type": option["type"],
+        "description": option.get("description", ""),
+        "required": option.get("required", False),
+        "choices": [{"name": c["name"], "value": c["value"]} for c in option.get("choices") or []],
+        "channel_types": sorted(option.get("channel_types") or []),
+        "min_value": option.get("min_value"),
+        "max_value": option.get("max_value"),
+        "min_length": option.get("min_length"),
+        "max_length": option.get("max_length"),
+        "autocomplete": option.get("autocomplete", False),
+        "options": [_normalize_option(o) for o in option.get("options") or []]
+    }
+
+def _normalize_command(command):
+    """Reduce a command payload to a comparable form"""
+    permissions = command.get("default_member_permissions")
+    return {
+        "name": command["name"],
+        "type": command.get("type", 1),
+        "description": command.get("description", ""),
+        "options": [_normalize_option(o) for o in command.get("options") or []],
+        "dm_permission": command.get("dm_permission", True),
+        "default_member_permissions": int(permissions) if permissions is not None else None,
+        "nsfw": command.get("nsfw", False)
+    }
+
+def command_hash(payloads):
+    """Hash a set of command payloads independently of order and omitted defaults"""
+    normalized = sorted((_normalize_command(p) for p in payloads), key=lambda c: (c["type"], c["name"]))
+    return hashlib.sha256(json.dumps(normalized, sort_keys=True).encode("utf-8")).hexdigest()
+
+def local_payloads(tree):
+    """Get the payloads the local command tree would sync"""
+    return [command.to_dict() for command in tree.get_commands()]
+
+def remote_payloads(app_commands):
+    """Get comparable payloads for commands fetched from Discord"""
+    payloads = []
+    for command in app_commands:
+        payload = command.to_dict()
+        payload["dm_permission"] = command.dm_permission
+        payload["nsfw"] = command.nsfw
+        permissions = command.default_member_permissions
+        payload["default_member_permissions"] = permissions.value if permissions is not None else None
+        payloads.append(payload)
+    return payloads
+
+def _read_stored_hash(path, application_id):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f).get(str(application_id))
+    except (OSError, ValueError):
+        return None
+
+def _write_stored_hash(path, application_id, digest):
+    try:
+        stored = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                stored = json.load(f)
+        stored[str(application_id)] = digest
+        with open(path, 'w') as f:
+            json.dump(stored, f)
+    except (OSError, ValueError) as e:
+        print(f"Error saving command sync state: {str(e)}")
+
+async def sync_commands_if_changed(tree, application_id, state_file=None, force=False):
+    """Sync global commands only if they differ from the last sync or from Discord; returns True if synced"""
+    state_file = state_file or BOT_SETTINGS.get("command_sync_file", "command_sync.json")
+    local_hash = command_hash(local_payloads(tree))
+    
+    # Same definitions as the last successful sync: no HTTP calls at all
+    if not force and _read_stored_hash(state_file, application_id) == local_hash:
+        print("Application commands unchanged since the last sync")
+        return False
+    
+    # The state file may be missing or stale, so ask Discord before overwriting anything
+    if not force:
+        remote_hash = command_hash(remote_payloads(await tree.fetch_commands()))
+        if remote_hash == local_hash:
+            _write_stored_hash(state_file, application_id, local_hash)
+            print("Application commands already match Discord")
+            return False
+    
+    synced = await tree.sync()
+    _write_stored_hash(state_file, application_id, local_hash)
+    print(f"Successfully registered {len(synced)} commands: {', '.join(cmd.name for cmd in synced)}")
+    return True
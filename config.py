@@ -7,22 +7,29 @@ DEFAULT_AI_MODES = {
     "general_chatting": {
         "name": "General Chatting",
         "description": "Have a casual conversation with the AI assistant.",
-        "system_prompt": ""
+        "system_prompt": "",
+        "context_budget": 2000,
+        "max_tokens": 300
     },
     "learning_assistant": {
         "name": "Learning Assistant",
         "description": "Get help with studying, homework, or learning new concepts.",
-        "system_prompt": "You are an educational AI assistant. Provide clear, accurate information to help the user learn. Break down complex topics, offer examples, and guide the user through their educational journey."
+        "system_prompt": "You are an educational AI assistant. Provide clear, accurate information to help the user learn. Break down complex topics, offer examples, and guide the user through their educational journey.",
+        "max_tokens": 800
     },
     "coding_helper": {
         "name": "Coding Helper",
         "description": "Get assistance with programming and coding tasks.",
-        "system_prompt": "You are a coding assistant. Help the user with programming questions, debugging, and explaining code concepts. Provide code examples when helpful."
+        "system_prompt": "You are a coding assistant. Help the user with programming questions, debugging, and explaining code concepts. Provide code examples when helpful.",
+        "context_budget": 8000,
+        "max_tokens": 1500
     },
     "creative_writing": {
         "name": "Creative Writing",
         "description": "Get help with creative writing, storytelling, or content creation.",
-        "system_prompt": "You are a creative writing assistant. Help the user with storytelling, content creation, and creative expression. Offer suggestions, feedback, and inspiration."
+        "system_prompt": "You are a creative writing assistant. Help the user with storytelling, content creation, and creative expression. Offer suggestions, feedback, and inspiration.",
+        "cache_responses": False,
+        "max_tokens": 1000
     },
     "language_tutor": {
         "name": "Language Tutor",
@@ -36,16 +43,148 @@ DEFAULT_AI_MODES = {
     }
 }
 
+# Modes may also set "context_budget": the maximum prompt tokens sent per request,
+# "max_tokens": the maximum reply tokens (BOT_SETTINGS["max_tokens"] if unset),
+# "model": the model to use instead of AI_MODEL from .env (e.g. "grok-3-beta" for coding_helper),
+# "fallback_model": the model to retry with when the mode's model fails (AI_MODEL if the mode sets its own model),
+# and "cache_responses": False to never answer from the response cache
+
 # Bot settings
 BOT_SETTINGS = {
     "default_mode": "general_chatting",
-    "max_tokens": 500,
+    "max_tokens": 500,  # Reply token limit for modes without their own "max_tokens"
     "user_data_file": "user_data.json",
-    "command_cooldown": 3  # seconds
+    "command_cooldown": 3,  # seconds (0 turns the slash command rate limit off)
+    "chat_history_page_size": 10,  # chats per /chathistory page (at most 23 so the page buttons still fit)
+    "stream_responses": True,  # Post replies early and edit them as text streams in
+    "stream_edit_interval": 1.0,  # seconds between edits of a streaming reply
+    "command_sync_file": "command_sync.json",  # Hash of the last synced slash commands
+    "force_command_sync": False  # Sync slash commands on startup even if they look unchanged
+}
+
+# Context window settings
+CONTEXT_SETTINGS = {
+    "input_budget": 4000,  # Default prompt token budget for modes without "context_budget"
+    "context_window": 32768,  # Model context window; the output budget is reserved inside it
+    "trim_ratio": 0.75,  # When the history overflows the budget, trim it to this share so the prompt prefix stays stable for a while
+    "prompt_cache_chats": 1000  # Chats whose prepared prompt messages are kept in memory
+}
+
+# Conversation summarization settings
+SUMMARY_SETTINGS = {
+    "enabled": True,  # Summarize older turns of long chats in the background
+    "idle_seconds": 120,  # Wait this long after the last reply before summarizing
+    "trigger_tokens": 3000,  # Summarize once unsummarized turns exceed this many tokens
+    "keep_recent_tokens": 1000,  # Recent turns left out of the summary
+    "max_tokens": 400,  # Output budget for the summary itself
+    "prune_summarized": False  # Delete summarized messages from storage
+}
+
+# Response cache settings
+RESPONSE_CACHE_SETTINGS = {
+    "enabled": False,  # Answer repeated prompts from a cache (per-mode "cache_responses" can opt out)
+    "max_entries": 1000,
+    "ttl": 600  # seconds a cached response stays valid; only identical prompts (whole history included) share a response
 }
 
 # API settings
 API_SETTINGS = {
-    "timeout": 30,  # seconds
-    "retry_attempts": 3
+    "timeout": 30,  # seconds per attempt
+    "retry_attempts": 3,  # Retries after the first attempt for timeouts, rate limits and server errors
+    "retry_base_delay": 0.5,  # seconds; doubles per retry with random jitter
+    "retry_max_delay": 8,  # seconds
+    "circuit_failure_threshold": 5,  # Consecutive failures before failing fast
+    "circuit_reset_timeout": 30,  # seconds before a trial request is let through
+    "async_client": True,  # Use the native asyncio client instead of a thread pool
+    "max_connections": 100,  # Maximum concurrent API connections
+    "max_keepalive_connections": 20,  # Idle connections kept open for reuse
+    "keepalive_expiry": 60,  # seconds an idle connection is kept open
+    "prewarm_connections": 2,  # Connections opened when the bot becomes ready
+    "max_in_flight_requests": 32,  # Global cap on API calls running at once
+    # OpenAI-compatible backends to spread requests over; empty uses AI_API_URL and XAI_API_KEY from .env
+    # e.g. {"name": "eu", "api_url": "https://...", "api_key_env": "XAI_API_KEY_EU", "weight": 2, "max_concurrency": 16}
+    "backends": [],
+    "latency_smoothing": 0.2,  # Weight of the newest request in each backend's average latency
+    "rate_limit_cooldown": 10  # seconds a rate-limited backend sits out when the API gives no Retry-After
+}
+
+# Request queue settings
+QUEUE_SETTINGS = {
+    "merge_pending_messages": True  # Merge a user's messages sent during an in-flight turn into the next turn
+}
+
+# Auto-reply burst batching settings
+BURST_SETTINGS = {
+    "window": 3.0,  # Default max seconds to gather a burst into one reply; guilds can override it with /autoreply
+    "max_window": 30.0,  # Largest window a guild can set
+    "max_batch": 20,  # Most messages answered by one reply
+    "rate_smoothing": 0.3  # Weight of the newest gap in each channel's average time between messages
+}
+
+# Rate limit and load shedding settings (a rate of 0 turns that limit off)
+RATE_LIMIT_SETTINGS = {
+    "user_rate": 0.5,  # Messages per second each user can keep up
+    "user_burst": 8,  # Messages a user can send at once before the rate applies
+    "guild_rate": 3.0,  # Messages per second each guild can keep up, across all its users
+    "guild_burst": 30,
+    "command_burst": 3,  # Slash commands a user can run at once; they refill one per command_cooldown
+    "max_queued_requests": 64,  # Turn away new requests once this many wait ahead of them for an API slot
+    "max_queue_age": 20,  # seconds; ...or once the oldest request ahead has waited this long
+    "busy_message": "I'm handling a lot of messages right now. Please try again in a moment.",
+    "rate_limited_message": "You're sending messages faster than I can answer. Please wait {seconds} seconds."
+}
+
+# API request scheduling settings
+SCHEDULER_SETTINGS = {
+    "guild_weights": {},  # Guild ID -> share of API slots relative to other guilds (default_weight if unset)
+    "default_weight": 1.0,
+    "dm_weight": 1.0  # Share of each user sending DMs
+}
+
+# Tracing settings
+TRACING_SETTINGS = {
+    "enabled": False,  # Record per-stage timings of replies
+    "sample_rate": 0.1,  # Share of replies traced
+    "file": "traces.jsonl",  # One OTLP-style span per line
+    "batch_size": 100  # Spans buffered before a write (a finished trace is always written)
+}
+
+# Metrics settings
+METRICS_SETTINGS = {
+    "enabled": False,  # Serve Prometheus metrics over HTTP (the /stats command works either way)
+    "host": "127.0.0.1",  # Keep the endpoint local unless a scraper needs it
+    "port": 9108,
+    "loop_lag_interval": 1.0  # seconds between event loop lag probes
+}
+
+# Sharding and cluster settings
+CLUSTER_SETTINGS = {
+    "auto_shard": False,  # Use AutoShardedBot in a single process
+    "clusters": 1,  # Worker processes started by "run_bot.py --clusters"; each owns a range of shards
+    "shard_count": None,  # Total shards; None asks Discord for the recommended count
+    "health_dir": "cluster_health",  # Each cluster writes its health report here
+    "health_interval": 15,  # seconds between health reports
+    "restart_delay": 5  # seconds before restarting a cluster that exited
+}
+
+# Storage settings
+STORAGE_SETTINGS = {
+    "backend": "json",  # "json" (single data file), "sqlite" or "sharded" (one file per user)
+    "sqlite_file": "user_data.db",
+    "sqlite_busy_timeout": 5,  # seconds to wait for another process's write lock
+    "sqlite_cached_chats": 1000,  # Conversations kept in memory so each turn only reads new messages
+    "shard_dir": "user_data",  # Directory of per-user files for the sharded backend
+    "hot_records": 10000,  # Sharded backend: records kept in memory before idle ones are evicted
+    "hot_bytes": 0,  # Sharded backend: optional memory budget for loaded records (0 = no limit)
+    "journal": False,  # Append each change to a journal instead of rewriting the data file
+    "journal_file": None,  # Defaults to "<user_data_file>.journal"
+    "journal_fsync": False,  # fsync after every journal record (slower, survives power loss)
+    "journal_compact_records": 1000,  # Compact the journal after this many records
+    "journal_compact_interval": 300,  # seconds between background compaction checks
+    # Coalesce changes (and journal records) and write them from a background thread.
+    # Changes from the last flush_interval_ms are only in memory: a clean shutdown
+    # (SIGTERM, SIGINT) flushes them, but a crash or SIGKILL loses them.
+    "write_behind": False,
+    "flush_interval_ms": 500,  # Write-behind flush interval
+    "flush_max_mutations": 100  # Flush early once this many changes are pending
 }
@@ -0,0 +1,148 @@
+"""
+Token counting and token-budgeted context windows for API requests
+"""
+
+from collections import OrderedDict
+
+from config import BOT_SETTINGS, CONTEXT_SETTINGS
+
+# Use a real tokenizer when one is installed, otherwise estimate
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except Exception:
+    _encoding = None
+
+# Approximate per-message overhead of the chat format (role, separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+def count_tokens(text):
+    """Count (or estimate) the number of tokens in a piece of text"""
+    if not text:
+        return 0
+    if _encoding:
+        return len(_encoding.encode(text))
+    # Roughly four characters per token for English text
+    return (len(text) + 3) // 4
+
+def message_tokens(conversation, index):
+    """Get a stored message's token count including chat format overhead"""
+    return conversation.tokens(index, count_tokens) + MESSAGE_OVERHEAD_TOKENS
+
+def get_budgets(mode_info):
+    """Get the (input, output) token budgets for a mode"""
+    output_budget = mode_info.get("max_tokens", BOT_SETTINGS.get("max_tokens", 500))
+    input_budget = mode_info.get("context_budget", CONTEXT_SETTINGS.get("input_budget", 4000))
+    
+    # Leave room for the reply inside the model's context window
+    context_window = CONTEXT_SETTINGS.get("context_window", 32768)
+    input_budget = min(input_budget, context_window - output_budget)
+    return input_budget, output_budget
+
+class PreparedMessages(list):
+    """API messages that were validated when they were added; AIHandler sends them as they are"""
+    __slots__ = ("tokens",)
+    
+    def __init__(self, messages, tokens):
+        super().__init__(messages)
+        self.tokens = tokens
+
+class _ChatPrompt:
+    """Prepared API messages for the recent window of one chat"""
+    __slots__ = ("messages", "tokens", "window_tokens", "consumed", "last", "summary", "budget")
+    
+    def __init__(self, summary, budget):
+        self.messages = []
+        self.tokens = []
+        self.window_tokens = 0
+        # Conversation messages seen so far, and the (content, timestamp) of the last one
+        self.consumed = 0
+        self.last = None
+        self.summary = summary
+        self.budget = budget
+
+class PromptBuilder:
+    """Builds API messages per chat incrementally, keeping the prompt prefix stable between turns"""
+    
+    def __init__(self, max_chats=None, trim_ratio=None):
+        self.max_chats = max_chats or CONTEXT_SETTINGS.get("prompt_cache_chats", 1000)
+        self.trim_ratio = trim_ratio or CONTEXT_SETTINGS.get("trim_ratio", 0.75)
+        # (user_id, chat_id) -> _ChatPrompt, least recently used first
+        self._chats = OrderedDict()
+        # system prompt -> the one message dict sent for it, so every request starts with the same bytes
+        self._system_messages = {}
+    
+    def _system_message(self, system_prompt):
+        message = self._system_messages.get(system_prompt)
+        if message is None:
+            message = self._system_messages[system_prompt] = {"role": "system", "content": system_prompt}
+        return message
+    
+    def _is_current(self, chat, conversation, summary, budget):
+        """Check that a cached chat still matches the stored conversation up to what it has seen"""
+        if chat.summary != summary or chat.budget != budget or chat.consumed > len(conversation):
+            return False
+        if not chat.consumed:
+            return True
+        last = conversation[chat.consumed - 1]
+        return (last.content, last.timestamp) == chat.last
+    
+    def _extend(self, chat, conversation, available):
+        """Add the conversation's new messages to the window, dropping old ones once it overflows"""
+        for index in range(chat.consumed, len(conversation)):
+            content = conversation.content(index)
+            # Validated once here instead of on every request
+            if content is None or not content.strip():
+                continue
+            tokens = message_tokens(conversation, index)
+            chat.messages.append({"role": conversation.role(index), "content": content})
+            chat.tokens.append(tokens)
+            chat.window_tokens += tokens
+        if len(conversation) > chat.consumed:
+            last = conversation[len(conversation) - 1]
+            chat.consumed = len(conversation)
+            chat.last = (last.content, last.timestamp)
+        
+        if chat.window_tokens <= available:
+            return
+        # Trim well below the budget so the window start (and the prompt prefix) stays put for several turns
+        target = available * self.trim_ratio
+        drop = 0
+        while drop < len(chat.messages) - 1 and chat.window_tokens > target:
+            chat.window_tokens -= chat.tokens[drop]
+            drop += 1
+        del chat.messages[:drop]
+        del chat.tokens[:drop]
+    
+    def build(self, key, system_prompt, conversation, input_budget, summary=None):
+        """Get the messages for a chat's next request, reusing what was prepared on earlier turns"""
+        system_message = self._system_message(system_prompt)
+        available = input_budget - count_tokens(system_prompt) - MESSAGE_OVERHEAD_TOKENS
+        summary_content = summary["content"] if summary else None
+        summary_message = None
+        if summary_content:
+            summary_message = {"role": "system", "content": f"Summary of the earlier conversation:\n{summary_content}"}
+            available -= count_tokens(summary_message["content"]) + MESSAGE_OVERHEAD_TOKENS
+        
+        chat = self._chats.get(key)
+        if chat is None or not self._is_current(chat, conversation, summary_content, input_budget):
+            # New chat, cleared, pruned, re-summarized or budget changed: start over from the stored messages
+            chat = _ChatPrompt(summary_content, input_budget)
+            chat.consumed = min(summary["covered"], len(conversation)) if summary else 0
+            if chat.consumed:
+                last = conversation[chat.consumed - 1]
+                chat.last = (last.content, last.timestamp)
+            self._chats[key] = chat
+        self._chats.move_to_end(key)
+        while len(self._chats) > self.max_chats:
+            self._chats.popitem(last=False)
+        
+        self._extend(chat, conversation, available)
+        
+        prefix = [system_message, summary_message] if summary_message else [system_message]
+        tokens = input_budget - available + chat.window_tokens
+        return PreparedMessages(prefix + chat.messages, tokens)
+    
+    def forget(self, key):
+        """Drop a chat's prepared messages"""
+        self._chats.pop(key, None)
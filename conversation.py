@@ -0,0 +1,135 @@
+"""
+Compact in-memory representation of a conversation
+"""
+
+import time
+from array import array
+
+# Roles are stored as one byte each instead of a string per message
+ROLES = ("system", "user", "assistant")
+ROLE_IDS = {role: index for index, role in enumerate(ROLES)}
+
+# Marks a message whose token count hasn't been computed yet
+UNKNOWN_TOKENS = -1
+
+class Message:
+    """Read-only view of one message in a Conversation"""
+    __slots__ = ("role", "content", "timestamp", "tokens")
+    
+    def __init__(self, role, content, timestamp, tokens):
+        self.role = role
+        self.content = content
+        self.timestamp = timestamp
+        self.tokens = tokens
+
+class Conversation:
+    """Array-backed list of messages with an interned role, timestamp and cached token count"""
+    __slots__ = ("_roles", "_contents", "_timestamps", "_tokens")
+    
+    def __init__(self):
+        self._roles = bytearray()
+        self._contents = []
+        self._timestamps = array("d")
+        self._tokens = array("l")
+    
+    @classmethod
+    def from_records(cls, records):
+        """Build a conversation from stored message dicts"""
+        conversation = cls()
+        for record in records:
+            conversation.append_record(record)
+        return conversation
+    
+    def append(self, role, content, tokens=None, timestamp=None):
+        """Add a message to the end of the conversation"""
+        self._roles.append(ROLE_IDS[role])
+        self._contents.append(content)
+        self._timestamps.append(time.time() if timestamp is None else timestamp)
+        self._tokens.append(UNKNOWN_TOKENS if tokens is None else tokens)
+    
+    def append_record(self, record):
+        """Add a message from its stored dict form"""
+        self.append(record["role"], record["content"], record.get("tokens"), record.get("timestamp", 0.0))
+    
+    def drop_first(self, count):
+        """Remove the oldest messages"""
+        del self._roles[:count]
+        del self._contents[:count]
+        del self._timestamps[:count]
+        del self._tokens[:count]
+    
+    def copy(self):
+        """Copy the message arrays; the content strings themselves are shared"""
+        conversation = Conversation()
+        conversation._roles = self._roles[:]
+        conversation._contents = self._contents[:]
+        conversation._timestamps = self._timestamps[:]
+        conversation._tokens = self._tokens[:]
+        return conversation
+    
+    def __len__(self):
+        return len(self._contents)
+    
+    def __getitem__(self, index):
+        return Message(ROLES[self._roles[index]], self._contents[index], self._timestamps[index], self._tokens[index])
+    
+    def __iter__(self):
+        for index in range(len(self._contents)):
+            yield self[index]
+    
+    def __eq__(self, other):
+        if not isinstance(other, Conversation):
+            return NotImplemented
+        return (self._roles == other._roles and self._contents == other._contents
+                and self._timestamps == other._timestamps and self._tokens == other._tokens)
+    
+    def role(self, index):
+        """Get a message's role"""
+        return ROLES[self._roles[index]]
+    
+    def content(self, index):
+        """Get a message's content"""
+        return self._contents[index]
+    
+    def tokens(self, index, count_tokens):
+        """Get a message's token count, counting and caching it on first use"""
+        tokens = self._tokens[index]
+        if tokens == UNKNOWN_TOKENS:
+            tokens = count_tokens(self._contents[index])
+            self._tokens[index] = tokens
+        return tokens
+    
+    def to_records(self):
+        """Build the dict form used for storage"""
+        records = []
+        for role, content, timestamp, tokens in zip(self._roles, self._contents, self._timestamps, self._tokens):
+            record = {"role": ROLES[role], "content": content, "timestamp": timestamp}
+            if tokens != UNKNOWN_TOKENS:
+                record["tokens"] = tokens
+            records.append(record)
+        return records
+
+def compact_user_record(record):
+    """Convert a loaded user record's conversations to Conversation objects in place"""
+    conversations = record.get("conversations")
+    if conversations:
+        for chat_id, chat in conversations.items():
+            if isinstance(chat, list):
+                conversations[chat_id] = Conversation.from_records(chat)
+    return record
+
+def snapshot(obj):
+    """Copy nested dicts, lists and conversations, so they can be serialized without a lock while the originals change"""
+    if isinstance(obj, dict):
+        return {key: snapshot(value) for key, value in obj.items()}
+    if isinstance(obj, list):
+        return [snapshot(value) for value in obj]
+    if isinstance(obj, Conversation):
+        return obj.copy()
+    return obj
+
+def encode_json(obj):
+    """json.dumps default hook that stores conversations as lists of message dicts"""
+    if isinstance(obj, Conversation):
+        return obj.to_records()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
@@ -0,0 +1,226 @@
+"""
+In-process metrics with a Prometheus text endpoint
+"""
+
+import time
+import asyncio
+import bisect
+import contextlib
+
+from aiohttp import web
+
+from config import METRICS_SETTINGS
+
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60)
+TOKEN_BUCKETS = (16, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384)
+FLUSH_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+BATCH_BUCKETS = (1, 2, 3, 5, 8, 13, 20)
+
+def _escape_label(value):
+    """Escape a label value for the text exposition format"""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(names, values, extra=()):
+    """Render a label set as {name="value",...}"""
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape_label(value)}"' for name, value in pairs) + "}"
+
+class Counter:
+    """Monotonically increasing count, optionally split by labels"""
+    kind = "counter"
+    
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.values = {}
+    
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+    
+    def total(self):
+        return sum(self.values.values())
+    
+    def render(self):
+        return [f"{self.name}{_format_labels(self.labels, key)} {value}" for key, value in self.values.items()]
+
+class Gauge:
+    """Value that goes up and down; a callback gauge reads its value when scraped"""
+    kind = "gauge"
+    
+    def __init__(self, name, description, labels=(), callback=None):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.callback = callback
+        self.values = {}
+    
+    def set(self, value, *label_values):
+        self.values[label_values] = value
+    
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+    
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+    
+    def get(self, *label_values):
+        if self.callback:
+            return self.callback()
+        return self.values.get(label_values, 0)
+    
+    def render(self):
+        if self.callback:
+            return [f"{self.name} {self.callback()}"]
+        return [f"{self.name}{_format_labels(self.labels, key)} {value}" for key, value in self.values.items()]
+
+class Histogram:
+    """Bucketed distribution of observations, optionally split by labels"""
+    kind = "histogram"
+    
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        # label values -> [per-bucket counts (last is +Inf), sum, count]
+        self.values = {}
+    
+    def observe(self, value, *label_values):
+        series = self.values.get(label_values)
+        if series is None:
+            series = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+    
+    def quantile(self, fraction, *label_values):
+        """Estimate a quantile by interpolating inside the bucket it falls in"""
+        series = self.values.get(label_values)
+        if not series or not series[2]:
+            return None
+        rank = fraction * series[2]
+        seen = 0
+        for index, count in enumerate(series[0]):
+            if seen + count >= rank and count:
+                lower = self.buckets[index - 1] if index else 0.0
+                if index == len(self.buckets):
+                    return lower
+                return lower + (self.buckets[index] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+    
+    def count(self, *label_values):
+        series = self.values.get(label_values)
+        return series[2] if series else 0
+    
+    def render(self):
+        lines = []
+        for key, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {count}")
+        return lines
+
+class MetricsRegistry:
+    """Holds every metric and renders them in the Prometheus text format"""
+    
+    def __init__(self):
+        self.metrics = {}
+    
+    def _register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+    
+    def counter(self, name, description, labels=()):
+        return self._register(Counter(name, description, labels))
+    
+    def gauge(self, name, description, labels=(), callback=None):
+        return self._register(Gauge(name, description, labels, callback))
+    
+    def histogram(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, description, labels, buckets))
+    
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = MetricsRegistry()
+
+API_LATENCY = REGISTRY.histogram("jbot_api_request_seconds", "AI API request latency, including retries", ("mode",))
+PROMPT_TOKENS = REGISTRY.histogram("jbot_prompt_tokens", "Tokens sent to the AI API per request", ("mode",), TOKEN_BUCKETS)
+COMPLETION_TOKENS = REGISTRY.histogram("jbot_completion_tokens", "Tokens received from the AI API per request", ("mode",), TOKEN_BUCKETS)
+API_ERRORS = REGISTRY.counter("jbot_api_errors_total", "AI requests that failed after retries", ("mode",))
+API_RETRIES = REGISTRY.counter("jbot_api_retries_total", "AI API attempts that were retried")
+MODEL_FALLBACKS = REGISTRY.counter("jbot_api_model_fallbacks_total", "AI requests retried with a mode's fallback model", ("mode",))
+BACKEND_REQUESTS = REGISTRY.counter("jbot_api_backend_attempts_total", "AI API attempts per backend by outcome", ("backend", "outcome"))
+IN_FLIGHT = REGISTRY.gauge("jbot_api_in_flight_requests", "AI API requests currently running")
+SCHEDULER_WAIT = REGISTRY.histogram("jbot_api_slot_wait_seconds", "Time AI requests waited for an API slot", ("class",))
+MESSAGES_SHED = REGISTRY.counter("jbot_messages_shed_total", "Messages and commands turned away by rate limits or load shedding", ("reason",))
+LOOP_LAG = REGISTRY.gauge("jbot_event_loop_lag_seconds", "How late the last event loop lag probe woke up")
+FLUSH_SECONDS = REGISTRY.gauge("jbot_user_data_flush_seconds", "Duration of the last user data save or flush")
+FLUSH_LATENCY = REGISTRY.histogram("jbot_user_data_flush_duration_seconds", "User data save and flush durations", buckets=FLUSH_BUCKETS)
+BURST_SIZE = REGISTRY.histogram("jbot_auto_reply_batch_size", "Auto-reply channel messages answered by one reply", buckets=BATCH_BUCKETS)
+
+@contextlib.contextmanager
+def record_flush():
+    """Record how long a user data save or flush takes"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        FLUSH_SECONDS.set(elapsed)
+        FLUSH_LATENCY.observe(elapsed)
+
+async def monitor_loop_lag(interval=None):
+    """Measure how late the event loop wakes a sleeping task"""
+    interval = interval or METRICS_SETTINGS.get("loop_lag_interval", 1.0)
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        LOOP_LAG.set(max(0.0, loop.time() - started - interval))
+
+class MetricsServer:
+    """Runs the loop lag probe and optionally serves the registry on a local HTTP endpoint"""
+    
+    def __init__(self, host=None, port=None):
+        self.host = host or METRICS_SETTINGS.get("host", "127.0.0.1")
+        self.port = port or METRICS_SETTINGS.get("port", 9108)
+        self._runner = None
+        self._lag_task = None
+    
+    async def handle_metrics(self, request):
+        return web.Response(text=REGISTRY.render(), content_type="text/plain", charset="utf-8")
+    
+    async def start(self, serve_http=True):
+        """Start the probe and endpoint; calling it again (e.g. on reconnect) does nothing"""
+        if not self._lag_task:
+            self._lag_task = asyncio.create_task(monitor_loop_lag())
+        if not serve_http or self._runner:
+            return
+        
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle_metrics)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        print(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+    
+    async def stop(self):
+        if self._lag_task:
+            self._lag_task.cancel()
+            self._lag_task = None
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
@@ -0,0 +1,73 @@
+"""
+Token-bucket rate limits per user and per guild
+"""
+
+import time
+from collections import OrderedDict
+
+class TokenBucket:
+    """Holds up to `capacity` tokens, refilled at `rate` tokens per second"""
+    __slots__ = ("rate", "capacity", "tokens", "updated", "warned")
+    
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+        # Set once the sender has been told they're limited, so they're told only once
+        self.warned = False
+    
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def take(self, now, cost=1):
+        """Spend tokens if there are enough"""
+        self.refill(now)
+        if self.tokens >= cost:
+            self.tokens -= cost
+            self.warned = False
+            return True
+        return False
+    
+    def retry_after(self, cost=1):
+        """Seconds until enough tokens have built up again"""
+        return max(0.0, (cost - self.tokens) / self.rate)
+    
+    def is_full(self, now):
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+class RateLimiter:
+    """Keeps a token bucket per key; buckets that have refilled are forgotten"""
+    
+    def __init__(self, rate, burst, max_keys=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        # key -> bucket, least recently used first
+        self._buckets = OrderedDict()
+    
+    @property
+    def enabled(self):
+        return bool(self.rate and self.burst)
+    
+    def take(self, key, cost=1):
+        """Spend from a key's bucket; returns (allowed, bucket), with no bucket when limits are off"""
+        if not self.enabled:
+            return True, None
+        
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.burst, now)
+        else:
+            self._buckets.move_to_end(key)
+        allowed = bucket.take(now, cost)
+        
+        # A full bucket is the same as no bucket, so dropping it loses nothing
+        while self._buckets:
+            oldest_key, oldest = next(iter(self._buckets.items()))
+            if oldest is bucket or (len(self._buckets) <= self.max_keys and not oldest.is_full(now)):
+                break
+            del self._buckets[oldest_key]
+        return allowed, bucket
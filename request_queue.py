@@ -0,0 +1,56 @@
+"""
+Per-key ordered processing of conversation turns
+"""
+
+import asyncio
+import traceback
+
+class TurnQueue:
+    """Processes queued items one turn at a time per key, in arrival order"""
+    
+    def __init__(self, process_turn, can_merge=None):
+        """process_turn(key, items) handles one turn; can_merge(first, item) decides which waiting items join it"""
+        self.process_turn = process_turn
+        self.can_merge = can_merge
+        # key -> items waiting for their turn
+        self._pending = {}
+        # key -> task draining that key's items
+        self._workers = {}
+    
+    def submit(self, key, item):
+        """Queue an item, starting a worker for its key if none is running"""
+        self._pending.setdefault(key, []).append(item)
+        if key not in self._workers:
+            self._workers[key] = asyncio.create_task(self._drain(key))
+    
+    def depth(self):
+        """Get the number of items waiting across all keys"""
+        return sum(len(items) for items in self._pending.values())
+    
+    def _next_turn(self, items):
+        """Take the next turn's items, merging waiting items when allowed"""
+        batch = [items.pop(0)]
+        if self.can_merge:
+            while items and self.can_merge(batch[0], items[0]):
+                batch.append(items.pop(0))
+        return batch
+    
+    async def _drain(self, key):
+        """Run turns for a key until nothing is waiting"""
+        try:
+            while self._pending.get(key):
+                batch = self._next_turn(self._pending[key])
+                try:
+                    await self.process_turn(key, batch)
+                except Exception as e:
+                    print(f"Error processing turn for {key}: {e}")
+                    traceback.print_exc()
+        finally:
+            self._pending.pop(key, None)
+            self._workers.pop(key, None)
+    
+    async def wait_idle(self, key):
+        """Wait until every item queued for a key has been processed"""
+        worker = self._workers.get(key)
+        if worker:
+            await asyncio.shield(worker)
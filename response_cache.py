@@ -0,0 +1,67 @@
+"""
+LRU + TTL cache of AI responses for repeated prompts
+"""
+
+import re
+import time
+import json
+import hashlib
+from collections import OrderedDict
+
+from config import RESPONSE_CACHE_SETTINGS
+
+class ResponseCache:
+    """Caches responses keyed by model and the whole normalized prompt"""
+    
+    def __init__(self, max_entries=None, ttl=None):
+        self.max_entries = max_entries or RESPONSE_CACHE_SETTINGS.get("max_entries", 1000)
+        self.ttl = ttl or RESPONSE_CACHE_SETTINGS.get("ttl", 600)
+        self.hits = 0
+        self.misses = 0
+        # key -> (expires_at, response), oldest first
+        self._entries = OrderedDict()
+    
+    def _normalize(self, text):
+        """Normalize text so trivially different prompts share a key"""
+        text = re.sub(r"\s+", " ", text.lower()).strip()
+        return text.rstrip("!?.,;: ")
+    
+    def make_key(self, model, messages, max_tokens=None):
+        """Build a cache key from the model and every prompt message, summaries included
+        
+        Keying on less than the whole prompt would let a follow-up in one conversation
+        be answered with a reply cached from another.
+        """
+        prompt = [(m["role"], self._normalize(m["content"])) for m in messages]
+        raw = json.dumps([model, max_tokens, prompt])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+    
+    def get(self, key):
+        """Get a cached response, or None if missing or expired"""
+        entry = self._entries.get(key)
+        if entry and entry[0] > time.monotonic():
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        
+        if entry:
+            del self._entries[key]
+        self.misses += 1
+        return None
+    
+    def put(self, key, response):
+        """Cache a response, evicting the least recently used entries over the size limit"""
+        self._entries[key] = (time.monotonic() + self.ttl, response)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+    
+    def stats(self):
+        """Get cache size and hit/miss counters"""
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0
+        }
@@ -6,6 +6,8 @@ This script provides a simple way to run the Discord AI bot.
 
 import os
 import sys
+import time
+import argparse
 import subprocess
 
 def check_dependencies():
@@ -69,12 +71,122 @@ def run_bot():
     try:
         import bot
         print("🤖 Starting Discord AI bot...")
-        bot.bot.run(bot.DISCORD_TOKEN)
+        try:
+            bot.bot.run(bot.DISCORD_TOKEN)
+        finally:
+            bot.user_handler.close()
     except Exception as e:
         print(f"❌ Failed to run bot: {str(e)}")
 
+def fetch_recommended_shards(token):
+    """Ask Discord how many shards the bot should use"""
+    import requests
+    response = requests.get(
+        "https://discord.com/api/v10/gateway/bot",
+        headers={"Authorization": f"Bot {token}"},
+        timeout=10
+    )
+    response.raise_for_status()
+    return response.json()["shards"]
+
+def start_cluster(cluster_id, shard_ids, shard_count):
+    """Start one worker process owning the given shards"""
+    from cluster import CLUSTER_ID_ENV, SHARD_IDS_ENV, SHARD_COUNT_ENV
+    env = dict(os.environ)
+    env[CLUSTER_ID_ENV] = str(cluster_id)
+    env[SHARD_IDS_ENV] = ",".join(str(shard_id) for shard_id in shard_ids)
+    env[SHARD_COUNT_ENV] = str(shard_count)
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")
+    print(f"🚀 Starting cluster {cluster_id} with shards {shard_ids[0]}-{shard_ids[-1]}")
+    return subprocess.Popen([sys.executable, script], env=env)
+
+def print_cluster_health(plan):
+    """Print one line per cluster from the health files the clusters write"""
+    from config import CLUSTER_SETTINGS
+    from cluster import read_health
+    stale_after = CLUSTER_SETTINGS.get("health_interval", 15) * 3
+    
+    for cluster_id, shard_ids in enumerate(plan):
+        report = read_health(cluster_id)
+        if not report:
+            print(f"⏳ Cluster {cluster_id}: no health report yet")
+            continue
+        
+        age = time.time() - report["updated_at"]
+        latencies = [s["latency_ms"] for s in report["shards"].values() if s["latency_ms"] is not None]
+        closed = sum(1 for s in report["shards"].values() if s["closed"])
+        status = "⚠️ stale" if age > stale_after else "✅ ready" if report["ready"] and not closed else "⏳ connecting"
+        print(
+            f"{status} Cluster {cluster_id} (pid {report['pid']}): shards {shard_ids[0]}-{shard_ids[-1]}, "
+            f"{report['guilds']} guilds, {closed} shards down, "
+            f"max latency {max(latencies) if latencies else 0:.0f} ms, "
+            f"{report.get('queue_depth', 0)} queued, {report.get('in_flight_requests', 0)} in flight, "
+            f"loop lag {report.get('loop_lag_ms', 0):.1f} ms, updated {age:.0f}s ago"
+        )
+
+def run_cluster(clusters, shard_count=None):
+    """Run the bot as several processes, each owning a contiguous range of shards"""
+    from dotenv import load_dotenv
+    from config import CLUSTER_SETTINGS, STORAGE_SETTINGS
+    from cluster import plan_clusters
+    load_dotenv()
+    
+    if STORAGE_SETTINGS.get("backend", "json") != "sqlite":
+        print("❌ Clusters share user data, which needs the sqlite storage backend.")
+        print("Set STORAGE_SETTINGS['backend'] = 'sqlite' in config.py (migrate with: python sqlite_storage.py).")
+        return
+    
+    shard_count = shard_count or CLUSTER_SETTINGS.get("shard_count")
+    if not shard_count:
+        try:
+            shard_count = fetch_recommended_shards(os.getenv("DISCORD_TOKEN"))
+        except Exception as e:
+            print(f"❌ Failed to get the recommended shard count: {str(e)}")
+            return
+    
+    plan = plan_clusters(shard_count, clusters)
+    print(f"🧩 Running {shard_count} shards in {len(plan)} clusters")
+    
+    workers = {}
+    try:
+        for cluster_id, shard_ids in enumerate(plan):
+            workers[cluster_id] = start_cluster(cluster_id, shard_ids, shard_count)
+            # Discord allows one shard to identify every few seconds; discord.py only paces shards within a process
+            if cluster_id + 1 < len(plan):
+                time.sleep(5 * len(shard_ids))
+        
+        interval = CLUSTER_SETTINGS.get("health_interval", 15)
+        while True:
+            time.sleep(interval)
+            for cluster_id, process in workers.items():
+                if process.poll() is not None:
+                    delay = CLUSTER_SETTINGS.get("restart_delay", 5)
+                    print(f"❌ Cluster {cluster_id} exited with code {process.returncode}, restarting in {delay}s")
+                    time.sleep(delay)
+                    workers[cluster_id] = start_cluster(cluster_id, plan[cluster_id], shard_count)
+            print_cluster_health(plan)
+    except KeyboardInterrupt:
+        print("🛑 Stopping clusters...")
+    finally:
+        for process in workers.values():
+            if process.poll() is None:
+                process.terminate()
+        for process in workers.values():
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
 def main():
     """Main function"""
+    from config import CLUSTER_SETTINGS
+    parser = argparse.ArgumentParser(description="Run the Discord AI bot")
+    parser.add_argument("--clusters", type=int, default=CLUSTER_SETTINGS.get("clusters", 1),
+                        help="number of worker processes, each owning a range of shards")
+    parser.add_argument("--shards", type=int, default=None,
+                        help="total shard count (default: Discord's recommendation)")
+    args = parser.parse_args()
+    
     print("=== Discord AI Bot Launcher ===")
     
     if not check_dependencies():
@@ -85,7 +197,10 @@ def main():
         print("❌ Please configure your .env file and try again.")
         return
     
-    run_bot()
+    if args.clusters > 1:
+        run_cluster(args.clusters, args.shards)
+    else:
+        run_bot()
 
 if __name__ == "__main__":
     main()
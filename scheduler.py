@@ -0,0 +1,137 @@
+"""
+Weighted fair sharing of AI API slots across guilds, with priority classes
+"""
+
+import time
+import heapq
+import asyncio
+import itertools
+import contextlib
+import contextvars
+
+from config import SCHEDULER_SETTINGS
+
+# Priority classes, served strictly in this order
+INTERACTIVE = "interactive"  # DMs and mentions
+AUTO_REPLY = "auto_reply"  # Auto-reply channel traffic
+BACKGROUND = "background"  # Summaries and anything else not tied to a message
+PRIORITY_CLASSES = (INTERACTIVE, AUTO_REPLY, BACKGROUND)
+
+# (flow, priority class) of the request the current task is making
+_request_class = contextvars.ContextVar("request_class", default=(None, BACKGROUND))
+
+@contextlib.contextmanager
+def request_class(flow, priority):
+    """Schedule API requests made by the enclosed code as part of a flow (a guild or DM user) and class"""
+    token = _request_class.set((flow, priority))
+    try:
+        yield
+    finally:
+        _request_class.reset(token)
+
+def current_request_class():
+    return _request_class.get()
+
+def flow_weight(flow):
+    """Get a flow's share of API slots relative to other flows in its class"""
+    if isinstance(flow, int):
+        weights = SCHEDULER_SETTINGS.get("guild_weights", {})
+        return weights.get(flow, weights.get(str(flow), SCHEDULER_SETTINGS.get("default_weight", 1.0)))
+    return SCHEDULER_SETTINGS.get("dm_weight", 1.0)
+
+class FairScheduler:
+    """Caps concurrent requests, handing free slots out by class and then by weighted fair queuing per flow"""
+    
+    def __init__(self, capacity, weight=flow_weight):
+        self.capacity = capacity
+        self.weight = weight
+        self.active = 0
+        self._seq = itertools.count()
+        # class -> heap of (finish tag, seq, start tag, flow, future)
+        self._queues = {priority: [] for priority in PRIORITY_CLASSES}
+        # class -> virtual time: the start tag of the request served last
+        self._virtual = dict.fromkeys(PRIORITY_CLASSES, 0.0)
+        # (class, flow) -> finish tag of the flow's last queued request
+        self._finish = {}
+        # class -> {future: time queued} in arrival order, so the oldest waiter is always first
+        self._waiting = {priority: {} for priority in PRIORITY_CLASSES}
+    
+    def queued(self, priority=None):
+        """Get the number of requests waiting, in one class or all of them"""
+        if priority:
+            return len(self._waiting[priority])
+        return sum(len(waiting) for waiting in self._waiting.values())
+    
+    def backlog(self, priority):
+        """Get how many requests wait ahead of a new request in a class, and how long the oldest has waited"""
+        count = 0
+        oldest = None
+        for ahead in PRIORITY_CLASSES[:PRIORITY_CLASSES.index(priority) + 1]:
+            waiting = self._waiting[ahead]
+            count += len(waiting)
+            if waiting:
+                queued_at = next(iter(waiting.values()))
+                oldest = queued_at if oldest is None else min(oldest, queued_at)
+        return count, time.monotonic() - oldest if oldest is not None else 0.0
+    
+    async def acquire(self, flow=None, priority=BACKGROUND):
+        """Wait for a slot; each request of a flow costs 1/weight of virtual time in its class"""
+        if self.active < self.capacity and not self.queued():
+            self.active += 1
+            return
+        
+        # Start-time fair queuing: a flow that sent nothing for a while starts at the current virtual time
+        key = (priority, flow)
+        start = max(self._virtual[priority], self._finish.get(key, 0.0))
+        finish = start + 1.0 / max(self.weight(flow), 1e-6)
+        self._finish[key] = finish
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queues[priority], (finish, next(self._seq), start, flow, future))
+        self._waiting[priority][future] = time.monotonic()
+        
+        try:
+            await future
+        except asyncio.CancelledError:
+            self._waiting[priority].pop(future, None)
+            # Cancelled after being handed a slot: give it to the next request
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+    
+    def release(self):
+        """Free a slot and hand it to the next waiting request"""
+        self.active -= 1
+        while self.active < self.capacity:
+            entry = self._next()
+            if entry is None:
+                return
+            future = entry[-1]
+            if future.cancelled():
+                continue
+            self.active += 1
+            future.set_result(None)
+    
+    def _next(self):
+        """Pop the waiting request with the earliest finish tag in the highest non-empty class"""
+        for priority in PRIORITY_CLASSES:
+            queue = self._queues[priority]
+            if queue:
+                entry = heapq.heappop(queue)
+                self._waiting[priority].pop(entry[-1], None)
+                self._virtual[priority] = entry[2]
+                if not queue:
+                    # The class is idle, so every flow starts afresh
+                    self._virtual[priority] = 0.0
+                    for key in [key for key in self._finish if key[0] == priority]:
+                        del self._finish[key]
+                return entry
+        return None
+    
+    @contextlib.asynccontextmanager
+    async def slot(self, flow=None, priority=BACKGROUND):
+        """Hold a slot for the enclosed request"""
+        await self.acquire(flow, priority)
+        try:
+            yield
+        finally:
+            self.release()
@@ -0,0 +1,219 @@
+"""
+Per-user sharded storage: one JSON file per user or guild, loaded on first access
+"""
+
+import os
+import sys
+import json
+from urllib.parse import quote, unquote
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+from config import BOT_SETTINGS, STORAGE_SETTINGS
+from user_data_handler import UserDataHandler, upgrade_user_record
+from conversation import encode_json, snapshot
+from metrics import record_flush
+
+class ShardedUserStore(MutableMapping):
+    """Dict-like view of per-record files with an LRU of hot records kept in memory"""
+    
+    def __init__(self, directory, lock, max_records=None, max_bytes=None):
+        self.directory = directory
+        self.lock = lock
+        self.max_records = max_records or STORAGE_SETTINGS.get("hot_records", 10000)
+        self.max_bytes = max_bytes or STORAGE_SETTINGS.get("hot_bytes", 0)
+        # key -> record, least recently used first
+        self._hot = OrderedDict()
+        # key -> serialized size when last loaded or written
+        self._sizes = {}
+        self._total_bytes = 0
+        self._dirty = set()
+    
+    def path(self, key):
+        """Get the file holding a record; users fan out into subdirectories"""
+        name = quote(key, safe="") + ".json"
+        if key.startswith("guild_"):
+            return os.path.join(self.directory, "guilds", name)
+        return os.path.join(self.directory, "users", name[-7:-5], name)
+    
+    def _load(self, key):
+        """Read a record from disk into the hot set"""
+        path = self.path(key)
+        try:
+            with open(path, 'r') as f:
+                payload = f.read()
+        except FileNotFoundError:
+            return None
+        record = upgrade_user_record(json.loads(payload))
+        self._remember(key, record, len(payload))
+        return record
+    
+    def _remember(self, key, record, size):
+        """Put a record in the hot set and evict idle records over the budget"""
+        self._hot[key] = record
+        self._hot.move_to_end(key)
+        self._total_bytes += size - self._sizes.get(key, 0)
+        self._sizes[key] = size
+        self._evict()
+    
+    def _evict(self):
+        """Drop least recently used records, writing them first if they have unsaved changes"""
+        while len(self._hot) > 1 and (
+            len(self._hot) > self.max_records or (self.max_bytes and self._total_bytes > self.max_bytes)
+        ):
+            key = next(iter(self._hot))
+            if key in self._dirty:
+                self.flush([key])
+            del self._hot[key]
+            self._total_bytes -= self._sizes.pop(key, 0)
+    
+    def __getitem__(self, key):
+        with self.lock:
+            if key in self._hot:
+                self._hot.move_to_end(key)
+                return self._hot[key]
+            record = self._load(key)
+        if record is None:
+            raise KeyError(key)
+        return record
+    
+    def __contains__(self, key):
+        # Loading here means the lookup that usually follows is a cache hit
+        try:
+            self[key]
+            return True
+        except KeyError:
+            return False
+    
+    def __setitem__(self, key, record):
+        with self.lock:
+            self._remember(key, record, self._sizes.get(key, 0))
+    
+    def __delitem__(self, key):
+        with self.lock:
+            self._hot.pop(key, None)
+            self._total_bytes -= self._sizes.pop(key, 0)
+            self._dirty.discard(key)
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                raise KeyError(key)
+    
+    def __iter__(self):
+        # Walks the directory, so this is O(records); only used by tools, never on the hot path
+        seen = set()
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith(".json"):
+                    key = unquote(name[:-5])
+                    seen.add(key)
+                    yield key
+        for key in list(self._hot):
+            if key not in seen:
+                yield key
+    
+    def __len__(self):
+        return sum(1 for _ in self)
+    
+    @property
+    def loaded_bytes(self):
+        """Serialized size of the records held in memory"""
+        return self._total_bytes
+    
+    def mark_dirty(self, key):
+        """Note that a hot record has changes that need writing"""
+        with self.lock:
+            self._dirty.add(key)
+    
+    def flush(self, keys=None):
+        """Write dirty records (or just the given ones) to their files"""
+        with self.lock:
+            keys = list(self._dirty if keys is None else keys)
+            records = {}
+            for key in keys:
+                if key in self._hot:
+                    records[key] = snapshot(self._hot[key])
+                self._dirty.discard(key)
+        
+        # Serialized outside the lock so mutations aren't held up
+        for key, record in records.items():
+            payload = json.dumps(record, default=encode_json)
+            path = self.path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'w') as f:
+                f.write(payload)
+            os.replace(tmp_path, path)
+            with self.lock:
+                if key in self._hot:
+                    self._total_bytes += len(payload) - self._sizes.get(key, 0)
+                    self._sizes[key] = len(payload)
+        return len(records)
+
+class ShardedUserDataHandler(UserDataHandler):
+    """User data handler that stores each user and guild in its own file and loads them lazily"""
+    
+    def __init__(self, shard_dir=None, write_behind=None):
+        self.shard_dir = shard_dir or STORAGE_SETTINGS.get("shard_dir", "user_data")
+        super().__init__(journal=False, write_behind=write_behind)
+    
+    def load_data(self):
+        """Open the shard directory; records are read on first access"""
+        os.makedirs(self.shard_dir, exist_ok=True)
+        return ShardedUserStore(self.shard_dir, self._lock)
+    
+    def _guild_records(self):
+        """Read the guild files only, leaving user files unread"""
+        guild_dir = os.path.join(self.shard_dir, "guilds")
+        if not os.path.isdir(guild_dir):
+            return
+        for name in os.listdir(guild_dir):
+            if not name.endswith(".json"):
+                continue
+            key = unquote(name[:-5])
+            yield int(key[len("guild_"):]), self.user_data.get(key) or {}
+    
+    def save_data(self):
+        """Write every record with unsaved changes"""
+        try:
+            with self._write_lock, record_flush():
+                with self._lock:
+                    self._dirty = 0
+                self.user_data.flush()
+            return True
+        except Exception as e:
+            print(f"Error saving user data: {str(e)}")
+            return False
+    
+    def data_size(self):
+        """Get the bytes of records currently loaded; the full directory is never walked"""
+        return self.user_data.loaded_bytes
+    
+    def _persist_record(self, op, fields):
+        """Mark the changed record dirty and write it now or in the background"""
+        self.user_data.mark_dirty(self._record_key(fields))
+        if self.write_behind:
+            with self._lock:
+                self._mark_dirty()
+        else:
+            self.save_data()
+
+def migrate_json_to_shards(json_file=None, shard_dir=None):
+    """Split a single JSON data file into per-user and per-guild files"""
+    source = UserDataHandler(json_file, journal=STORAGE_SETTINGS.get("journal", False), write_behind=False)
+    target = ShardedUserDataHandler(shard_dir, write_behind=False)
+    
+    for key, record in source.user_data.items():
+        target.user_data[key] = record
+        target.user_data.mark_dirty(key)
+        target.user_data.flush([key])
+    
+    source.close()
+    print(f"Migrated {len(source.user_data)} records into {target.shard_dir}")
+
+if __name__ == "__main__":
+    # Usage: python sharded_storage.py [user_data.json] [user_data_dir]
+    if not os.path.exists(sys.argv[1] if len(sys.argv) > 1 else BOT_SETTINGS.get("user_data_file", "user_data.json")):
+        print("No JSON user data file found to migrate.")
+    else:
+        migrate_json_to_shards(*sys.argv[1:3])
@@ -0,0 +1,512 @@
+"""
+SQLite storage backend for user and guild data
+"""
+
+import os
+import sys
+import json
+import uuid
+import time
+import sqlite3
+import datetime
+import threading
+import contextlib
+from collections import OrderedDict
+
+# Import configuration
+from config import BOT_SETTINGS, STORAGE_SETTINGS
+from context_builder import count_tokens
+from conversation import Conversation
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    current_mode TEXT NOT NULL,
+    current_chat_id TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS chats (
+    user_id TEXT NOT NULL,
+    chat_id TEXT NOT NULL,
+    name TEXT,
+    created_at TEXT,
+    updated_at REAL,
+    message_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, chat_id)
+);
+CREATE TABLE IF NOT EXISTS messages (
+    user_id TEXT NOT NULL,
+    chat_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    tokens INTEGER,
+    timestamp REAL,
+    PRIMARY KEY (user_id, chat_id, seq)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS summaries (
+    user_id TEXT NOT NULL,
+    chat_id TEXT NOT NULL,
+    content TEXT NOT NULL,
+    covered INTEGER NOT NULL,
+    PRIMARY KEY (user_id, chat_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS guild_channels (
+    guild_id TEXT NOT NULL,
+    channel_id TEXT NOT NULL,
+    PRIMARY KEY (guild_id, channel_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS guild_settings (
+    guild_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (guild_id, name)
+) WITHOUT ROWID;
+"""
+
+@contextlib.contextmanager
+def transaction(conn, begin="BEGIN IMMEDIATE"):
+    """Run the enclosed statements as one transaction, rolling it back if any of them fails
+    
+    Without the rollback a failed statement (disk full, I/O error) would leave the connection
+    inside the transaction, and every later BEGIN would fail until a restart.
+    """
+    conn.execute(begin)
+    try:
+        yield conn
+    except BaseException:
+        # SQLite rolls back by itself after some errors
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+class SQLiteUserDataHandler:
+    """User data handler backed by a SQLite database in WAL mode"""
+    
+    def __init__(self, db_file=None):
+        """Open the database and make sure the schema exists"""
+        self.db_file = db_file or STORAGE_SETTINGS.get("sqlite_file", "user_data.db")
+        self._lock = threading.RLock()
+        self.cached_chats = STORAGE_SETTINGS.get("sqlite_cached_chats", 1000)
+        # (user_id, chat_id) -> (conversation, first seq, last seq, (content, timestamp) of the last row),
+        # least recently used first; each turn then only reads the rows added since the last one
+        self._conversations = OrderedDict()
+        
+        # Autocommit mode; multi-statement changes use explicit transactions
+        # Other bot processes may hold the write lock briefly, so wait for it instead of failing
+        self.conn = sqlite3.connect(
+            self.db_file,
+            isolation_level=None,
+            check_same_thread=False,
+            timeout=STORAGE_SETTINGS.get("sqlite_busy_timeout", 5)
+        )
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        
+        # Databases created by older versions lack the message metadata columns
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(messages)")]
+        for column, column_type in (("tokens", "INTEGER"), ("timestamp", "REAL")):
+            if column not in columns:
+                self.conn.execute(f"ALTER TABLE messages ADD COLUMN {column} {column_type}")
+        
+        # Chat metadata is kept on the chats row so listing chats never touches messages
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(chats)")]
+        if "message_count" not in columns:
+            with transaction(self.conn):
+                self.conn.execute("ALTER TABLE chats ADD COLUMN updated_at REAL")
+                self.conn.execute("ALTER TABLE chats ADD COLUMN message_count INTEGER NOT NULL DEFAULT 0")
+                self.conn.execute(
+                    """
+                    UPDATE chats SET
+                        message_count = (SELECT COUNT(*) FROM messages m WHERE m.user_id = chats.user_id AND m.chat_id = chats.chat_id),
+                        updated_at = (SELECT MAX(timestamp) FROM messages m WHERE m.user_id = chats.user_id AND m.chat_id = chats.chat_id)
+                    """
+                )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS chats_by_update ON chats (user_id, updated_at)")
+        
+        # (guild_id, channel_id) pairs with auto-replies on, as ints, for lookups that never touch the database
+        self.enabled_channels = {
+            (int(guild_id), int(channel_id))
+            for guild_id, channel_id in self.conn.execute("SELECT guild_id, channel_id FROM guild_channels")
+        }
+        # Per-guild settings, keyed by int guild ID; values are stored as JSON
+        self.guild_settings = {}
+        for guild_id, name, value in self.conn.execute("SELECT guild_id, name, value FROM guild_settings"):
+            self.guild_settings.setdefault(int(guild_id), {})[name] = json.loads(value)
+    
+    def save_data(self):
+        """Every change is written immediately, so there is nothing to save"""
+        return True
+    
+    def data_size(self):
+        """Get the bytes of the database and its write-ahead log"""
+        paths = (self.db_file, f"{self.db_file}-wal")
+        return sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+    
+    def close(self):
+        """Close the database connection"""
+        with self._lock:
+            self.conn.close()
+    
+    def _ensure_user(self, user_id):
+        """Create the user's row and default chat if they don't exist"""
+        row = self.conn.execute(
+            "SELECT current_mode, current_chat_id FROM users WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        if row:
+            return row
+        
+        # Another process may create the same user concurrently; whichever row lands first wins
+        default_mode = BOT_SETTINGS.get("default_mode", "general_chatting")
+        with transaction(self.conn):
+            self.conn.execute(
+                "INSERT OR IGNORE INTO users (user_id, current_mode, current_chat_id) VALUES (?, ?, 'default')",
+                (user_id, default_mode)
+            )
+            self.conn.execute(
+                "INSERT OR IGNORE INTO chats (user_id, chat_id, name, created_at, updated_at) VALUES (?, 'default', NULL, ?, ?)",
+                (user_id, datetime.datetime.now().isoformat(), time.time())
+            )
+            row = self.conn.execute(
+                "SELECT current_mode, current_chat_id FROM users WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        return row
+    
+    def get_user_data(self, user_id):
+        """Get user settings, initializing if they don't exist (conversations are not loaded)"""
+        with self._lock:
+            current_mode, current_chat_id = self._ensure_user(user_id)
+        return {
+            "current_mode": current_mode,
+            "current_chat_id": current_chat_id
+        }
+    
+    def is_channel_enabled(self, guild_id, channel_id):
+        """Check whether a channel has auto-replies on; takes Discord's int IDs and never touches storage"""
+        return (guild_id, channel_id) in self.enabled_channels
+    
+    def get_guild_data(self, guild_id):
+        """Get guild data"""
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT channel_id FROM guild_channels WHERE guild_id = ?", (guild_id,)
+            ).fetchall()
+        return {
+            "enabled_channels": [row[0] for row in rows],
+            **self.guild_settings.get(int(guild_id), {})
+        }
+    
+    def get_guild_setting(self, guild_id, name, default=None):
+        """Get a guild setting; takes Discord's int guild ID and never touches the database"""
+        return self.guild_settings.get(guild_id, {}).get(name, default)
+    
+    def set_guild_setting(self, guild_id, name, value):
+        """Store a guild setting, or remove it when value is None"""
+        with self._lock:
+            settings = self.guild_settings.setdefault(int(guild_id), {})
+            if value is None:
+                self.conn.execute("DELETE FROM guild_settings WHERE guild_id = ? AND name = ?", (guild_id, name))
+                settings.pop(name, None)
+            else:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO guild_settings (guild_id, name, value) VALUES (?, ?, ?)",
+                    (guild_id, name, json.dumps(value))
+                )
+                settings[name] = value
+    
+    def enable_channel(self, guild_id, channel_id):
+        """Enable a channel for automatic AI responses"""
+        with self._lock:
+            cursor = self.conn.execute(
+                "INSERT OR IGNORE INTO guild_channels (guild_id, channel_id) VALUES (?, ?)",
+                (guild_id, channel_id)
+            )
+            self.enabled_channels.add((int(guild_id), int(channel_id)))
+        return cursor.rowcount > 0
+    
+    def disable_channel(self, guild_id, channel_id):
+        """Disable a channel for automatic AI responses"""
+        with self._lock:
+            cursor = self.conn.execute(
+                "DELETE FROM guild_channels WHERE guild_id = ? AND channel_id = ?",
+                (guild_id, channel_id)
+            )
+            self.enabled_channels.discard((int(guild_id), int(channel_id)))
+        return cursor.rowcount > 0
+    
+    def set_user_mode(self, user_id, mode):
+        """Set the user's current AI mode"""
+        with self._lock:
+            self._ensure_user(user_id)
+            self.conn.execute("UPDATE users SET current_mode = ? WHERE user_id = ?", (mode, user_id))
+    
+    def create_new_chat(self, user_id, name=None):
+        """Create a new chat for the user"""
+        # Generate chat ID and name
+        chat_id = str(uuid.uuid4())
+        now = datetime.datetime.now()
+        if not name:
+            name = f"Chat {now.strftime('%Y-%m-%d %H:%M')}"
+        
+        with self._lock:
+            self._ensure_user(user_id)
+            with transaction(self.conn):
+                self.conn.execute(
+                    "INSERT INTO chats (user_id, chat_id, name, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                    (user_id, chat_id, name, now.isoformat(), now.timestamp())
+                )
+                self.conn.execute("UPDATE users SET current_chat_id = ? WHERE user_id = ?", (chat_id, user_id))
+        
+        return chat_id, name
+    
+    def get_chat_history(self, user_id):
+        """Get the user's chats as (chat_id, name, message_count), most recently updated first"""
+        chats, _ = self.get_chat_page(user_id, 0, None)
+        return [(chat_id, name, count) for chat_id, name, count, _ in chats]
+    
+    def get_chat_page(self, user_id, offset, limit):
+        """Get one page of (chat_id, name, message_count, updated) from the chats table, and the total chat count"""
+        with self._lock:
+            rows = self.conn.execute(
+                """
+                SELECT chat_id, name, message_count, updated_at FROM chats
+                WHERE user_id = ? AND chat_id != 'default'
+                ORDER BY updated_at DESC
+                LIMIT ? OFFSET ?
+                """,
+                (user_id, -1 if limit is None else limit, offset)
+            ).fetchall()
+            total = self.conn.execute(
+                "SELECT COUNT(*) FROM chats WHERE user_id = ? AND chat_id != 'default'", (user_id,)
+            ).fetchone()[0]
+        
+        return [(chat_id, name or f"Chat {chat_id[:8]}", count, updated) for chat_id, name, count, updated in rows], total
+    
+    def switch_chat(self, user_id, chat_id):
+        """Switch the user to a different chat"""
+        with self._lock:
+            self._ensure_user(user_id)
+            exists = self.conn.execute(
+                "SELECT 1 FROM chats WHERE user_id = ? AND chat_id = ?", (user_id, chat_id)
+            ).fetchone()
+            if not exists:
+                return False
+            self.conn.execute("UPDATE users SET current_chat_id = ? WHERE user_id = ?", (chat_id, user_id))
+        return True
+    
+    def clear_chat(self, user_id, chat_id=None):
+        """Clear a user's chat history"""
+        with self._lock:
+            _, current_chat_id = self._ensure_user(user_id)
+            if not chat_id:
+                chat_id = current_chat_id
+            
+            exists = self.conn.execute(
+                "SELECT 1 FROM chats WHERE user_id = ? AND chat_id = ?", (user_id, chat_id)
+            ).fetchone()
+            if not exists:
+                return False
+            self._conversations.pop((user_id, chat_id), None)
+            with transaction(self.conn):
+                self.conn.execute("DELETE FROM messages WHERE user_id = ? AND chat_id = ?", (user_id, chat_id))
+                self.conn.execute("DELETE FROM summaries WHERE user_id = ? AND chat_id = ?", (user_id, chat_id))
+                self.conn.execute(
+                    "UPDATE chats SET message_count = 0 WHERE user_id = ? AND chat_id = ?", (user_id, chat_id)
+                )
+        return True
+    
+    def add_message(self, user_id, role, content):
+        """Add a message to the user's current conversation"""
+        # Don't add messages with null or empty content
+        if content is None or (isinstance(content, str) and not content.strip()):
+            print(f"Warning: Attempted to add message with empty content for user {user_id}")
+            return
+        
+        now = time.time()
+        with self._lock:
+            _, chat_id = self._ensure_user(user_id)
+            with transaction(self.conn):
+                # The next sequence number comes from the primary key index, so this is one row insert
+                self.conn.execute(
+                    """
+                    INSERT INTO messages (user_id, chat_id, seq, role, content, tokens, timestamp)
+                    SELECT ?, ?, COALESCE(MAX(seq), 0) + 1, ?, ?, ?, ?
+                    FROM messages WHERE user_id = ? AND chat_id = ?
+                    """,
+                    (user_id, chat_id, role, content, count_tokens(content), now, user_id, chat_id)
+                )
+                self.conn.execute(
+                    "UPDATE chats SET message_count = message_count + 1, updated_at = ? WHERE user_id = ? AND chat_id = ?",
+                    (now, user_id, chat_id)
+                )
+    
+    def get_conversation(self, user_id, chat_id=None):
+        """Get a user's conversation"""
+        with self._lock:
+            _, current_chat_id = self._ensure_user(user_id)
+            if not chat_id:
+                chat_id = current_chat_id
+            
+            key = (user_id, chat_id)
+            cached = self._conversations.get(key)
+            if cached:
+                conversation, first_seq, last_seq, last = cached
+                # Read from the last known row on, and check it and the first row are unchanged;
+                # another process may have cleared or pruned the chat since
+                rows = self.conn.execute(
+                    "SELECT seq, role, content, tokens, timestamp FROM messages WHERE user_id = ? AND chat_id = ? AND seq >= ? ORDER BY seq",
+                    (user_id, chat_id, last_seq)
+                ).fetchall()
+                oldest = self.conn.execute(
+                    "SELECT MIN(seq) FROM messages WHERE user_id = ? AND chat_id = ?", (user_id, chat_id)
+                ).fetchone()[0]
+                if oldest == first_seq and rows and (rows[0][0], rows[0][2], rows[0][4]) == (last_seq, *last):
+                    rows = rows[1:]
+                else:
+                    cached = None
+            if not cached:
+                conversation = Conversation()
+                rows = self.conn.execute(
+                    "SELECT seq, role, content, tokens, timestamp FROM messages WHERE user_id = ? AND chat_id = ? ORDER BY seq",
+                    (user_id, chat_id)
+                ).fetchall()
+                first_seq = rows[0][0] if rows else None
+            
+            for _, role, content, tokens, timestamp in rows:
+                conversation.append(role, content, tokens, timestamp or 0.0)
+            
+            if rows:
+                seq, _, content, _, timestamp = rows[-1]
+                self._conversations[key] = (conversation, first_seq, seq, (content, timestamp))
+            elif not cached:
+                # Empty chats have no row to check against, so they are read again next time
+                self._conversations.pop(key, None)
+            if key in self._conversations:
+                self._conversations.move_to_end(key)
+                while len(self._conversations) > self.cached_chats:
+                    self._conversations.popitem(last=False)
+        
+        return conversation
+    
+    def get_current_mode(self, user_id):
+        """Get the user's current AI mode"""
+        with self._lock:
+            current_mode, _ = self._ensure_user(user_id)
+        return current_mode
+
+    def get_summary(self, user_id, chat_id=None):
+        """Get the rolling summary of a conversation's older messages"""
+        with self._lock:
+            _, current_chat_id = self._ensure_user(user_id)
+            if not chat_id:
+                chat_id = current_chat_id
+            
+            row = self.conn.execute(
+                "SELECT content, covered FROM summaries WHERE user_id = ? AND chat_id = ?", (user_id, chat_id)
+            ).fetchone()
+        
+        if not row:
+            return None
+        return {"content": row[0], "covered": row[1]}
+    
+    def set_summary(self, user_id, chat_id, content, covered, prune=False):
+        """Store a summary of a chat's first `covered` messages, optionally dropping those messages"""
+        with self._lock:
+            exists = self.conn.execute(
+                "SELECT 1 FROM chats WHERE user_id = ? AND chat_id = ?", (user_id, chat_id)
+            ).fetchone()
+            if not exists:
+                return False
+            
+            with transaction(self.conn):
+                if prune:
+                    self._conversations.pop((user_id, chat_id), None)
+                    deleted = self.conn.execute(
+                        """
+                        DELETE FROM messages WHERE user_id = ? AND chat_id = ? AND seq IN (
+                            SELECT seq FROM messages WHERE user_id = ? AND chat_id = ? ORDER BY seq LIMIT ?
+                        )
+                        """,
+                        (user_id, chat_id, user_id, chat_id, covered)
+                    ).rowcount
+                    self.conn.execute(
+                        "UPDATE chats SET message_count = message_count - ? WHERE user_id = ? AND chat_id = ?",
+                        (deleted, user_id, chat_id)
+                    )
+                    covered = 0
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO summaries (user_id, chat_id, content, covered) VALUES (?, ?, ?, ?)",
+                    (user_id, chat_id, content, covered)
+                )
+        return True
+
+def migrate_json_to_sqlite(json_file=None, db_file=None):
+    """Copy every user and guild from a JSON data file into a SQLite database"""
+    from user_data_handler import UserDataHandler
+    
+    # Loading through the JSON handler also replays a pending journal
+    source = UserDataHandler(json_file, journal=STORAGE_SETTINGS.get("journal", False))
+    target = SQLiteUserDataHandler(db_file)
+    users = guilds = messages = 0
+    
+    with target._lock:
+        conn = target.conn
+        with transaction(conn, "BEGIN"):
+            for key, record in source.user_data.items():
+                if key.startswith("guild_"):
+                    guild_id = key[len("guild_"):]
+                    conn.executemany(
+                        "INSERT OR IGNORE INTO guild_channels (guild_id, channel_id) VALUES (?, ?)",
+                        [(guild_id, channel_id) for channel_id in record.get("enabled_channels", [])]
+                    )
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO guild_settings (guild_id, name, value) VALUES (?, ?, ?)",
+                        [(guild_id, name, json.dumps(value)) for name, value in record.items() if name != "enabled_channels"]
+                    )
+                    guilds += 1
+                    continue
+            
+                conversations = record.get("conversations", {})
+                chats = record.get("chats", {})
+                conn.execute(
+                    "INSERT OR REPLACE INTO users (user_id, current_mode, current_chat_id) VALUES (?, ?, ?)",
+                    (key, record.get("current_mode", BOT_SETTINGS.get("default_mode", "general_chatting")),
+                     record.get("current_chat_id", "default"))
+                )
+                for chat_id, chat in conversations.items():
+                    meta = chats.get(chat_id, {})
+                    created = meta.get("created")
+                    conn.execute(
+                        """
+                        INSERT OR REPLACE INTO chats (user_id, chat_id, name, created_at, updated_at, message_count)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                        """,
+                        (key, chat_id, meta.get("name"),
+                         datetime.datetime.fromtimestamp(created).isoformat() if created else None,
+                         meta.get("updated"), len(chat))
+                    )
+                    conn.execute("DELETE FROM messages WHERE user_id = ? AND chat_id = ?", (key, chat_id))
+                    conn.executemany(
+                        "INSERT INTO messages (user_id, chat_id, seq, role, content, tokens, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        [(key, chat_id, seq, msg.role, msg.content, chat.tokens(seq - 1, count_tokens), msg.timestamp)
+                         for seq, msg in enumerate(chat, 1)]
+                    )
+                    messages += len(chat)
+                for chat_id, summary in record.get("summaries", {}).items():
+                    conn.execute(
+                        "INSERT OR REPLACE INTO summaries (user_id, chat_id, content, covered) VALUES (?, ?, ?, ?)",
+                        (key, chat_id, summary["content"], summary["covered"])
+                    )
+                users += 1
+    
+    source.close()
+    target.close()
+    print(f"Migrated {users} users, {guilds} guilds and {messages} messages into {target.db_file}")
+
+if __name__ == "__main__":
+    # Usage: python sqlite_storage.py [user_data.json] [user_data.db]
+    if not os.path.exists(sys.argv[1] if len(sys.argv) > 1 else BOT_SETTINGS.get("user_data_file", "user_data.json")):
+        print("No JSON user data file found to migrate.")
+    else:
+        migrate_json_to_sqlite(*sys.argv[1:3])
@@ -0,0 +1,105 @@
+"""
+Background summarization of long conversations
+"""
+
+import asyncio
+import contextvars
+
+from config import SUMMARY_SETTINGS
+from ai_handler import AIServiceError
+from context_builder import message_tokens
+from user_data_handler import run_storage
+
+SUMMARY_PROMPT = (
+    "You maintain a running summary of a conversation between a user and an AI assistant. "
+    "Combine the existing summary with the new messages into one concise summary that keeps "
+    "facts, names, decisions, open questions and the user's preferences. Reply with the summary only."
+)
+
+class ConversationSummarizer:
+    """Folds the older turns of idle chats into a rolling summary"""
+    
+    def __init__(self, ai_handler, user_handler):
+        self.ai_handler = ai_handler
+        self.user_handler = user_handler
+        # (user_id, chat_id) -> task waiting for the chat to go idle
+        self._timers = {}
+    
+    def schedule(self, user_id, chat_id):
+        """Summarize a user's chat once it has been idle for a while"""
+        if not SUMMARY_SETTINGS.get("enabled", False):
+            return
+        
+        key = (user_id, chat_id)
+        
+        # New activity restarts the idle timer
+        timer = self._timers.pop(key, None)
+        if timer:
+            timer.cancel()
+        # Start from an empty context: the summary is background work, not part of the reply's
+        # scheduling class or trace that happen to be current here
+        self._timers[key] = asyncio.create_task(self._run_when_idle(user_id, chat_id), context=contextvars.Context())
+    
+    async def _run_when_idle(self, user_id, chat_id):
+        """Wait for the chat to go idle, then summarize it"""
+        await asyncio.sleep(SUMMARY_SETTINGS.get("idle_seconds", 120))
+        
+        # From here on the summary is no longer cancelled by new messages
+        self._timers.pop((user_id, chat_id), None)
+        try:
+            await self.summarize(user_id, chat_id)
+        except Exception as e:
+            print(f"Error summarizing chat {chat_id} for user {user_id}: {e}")
+    
+    async def summarize(self, user_id, chat_id):
+        """Fold older unsummarized turns of a chat into its summary"""
+        conversation = await run_storage(self.user_handler.get_conversation, user_id, chat_id)
+        summary = await run_storage(self.user_handler.get_summary, user_id, chat_id)
+        covered = summary["covered"] if summary else 0
+        
+        pending = [message_tokens(conversation, index) for index in range(covered, len(conversation))]
+        if sum(pending) < SUMMARY_SETTINGS.get("trigger_tokens", 3000):
+            return False
+        
+        # Leave the most recent turns out of the summary
+        keep = SUMMARY_SETTINGS.get("keep_recent_tokens", 1000)
+        split = len(conversation)
+        while split > covered and keep - pending[split - covered - 1] >= 0:
+            keep -= pending[split - covered - 1]
+            split -= 1
+        if split <= covered:
+            return False
+        
+        transcript = "\n\n".join(
+            f"{conversation.role(index).capitalize()}: {conversation.content(index)}" for index in range(covered, split)
+        )
+        previous = summary["content"] if summary else "(none)"
+        request = [
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": f"Existing summary:\n{previous}\n\nNew messages:\n{transcript}"}
+        ]
+        last_content = conversation.content(split - 1)
+        
+        try:
+            new_summary = await self.ai_handler.generate_response(request, SUMMARY_SETTINGS.get("max_tokens", 400))
+        except AIServiceError as e:
+            print(f"Skipping summary of chat {chat_id} for user {user_id}: {e}")
+            return False
+        
+        def store_summary():
+            # Skip the result if the chat was cleared or rewritten while the summary was generated
+            conversation = self.user_handler.get_conversation(user_id, chat_id)
+            if len(conversation) < split or conversation.content(split - 1) != last_content:
+                return False
+            
+            self.user_handler.set_summary(
+                user_id, chat_id, new_summary, split,
+                prune=SUMMARY_SETTINGS.get("prune_summarized", False)
+            )
+            return True
+        
+        # Check and store on the storage thread, so no change to the chat lands in between
+        if not await run_storage(store_summary):
+            return False
+        print(f"Summarized {split - covered} messages of chat {chat_id} for user {user_id}")
+        return True
@@ -0,0 +1,129 @@
+"""
+Sampled per-request tracing with a JSONL file exporter
+"""
+
+import os
+import json
+import time
+import random
+import threading
+import contextlib
+import contextvars
+
+from config import TRACING_SETTINGS
+
+# Span the current task is working inside
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+class Span:
+    """One timed stage of a trace; spans of unsampled traces are never created"""
+    __slots__ = ("tracer", "trace_id", "span_id", "parent_id", "name", "start", "end_time", "attributes")
+    sampled = True
+
+    def __init__(self, tracer, trace_id, parent_id, name, attributes):
+        self.tracer = tracer
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.start = time.time_ns()
+        self.end_time = None
+        self.attributes = attributes
+
+    def set(self, **attributes):
+        """Add attributes to the span"""
+        self.attributes.update(attributes)
+
+    def end(self):
+        """Finish the span and hand it to the exporter; ending twice does nothing"""
+        if self.end_time is None:
+            self.end_time = time.time_ns()
+            self.tracer.export(self)
+
+    def to_dict(self):
+        """OTLP-style JSON form of the span"""
+        return {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_id,
+            "name": self.name,
+            "startTimeUnixNano": self.start,
+            "endTimeUnixNano": self.end_time,
+            "durationMs": (self.end_time - self.start) / 1e6,
+            "attributes": self.attributes
+        }
+
+class NoopSpan:
+    """Stands in for spans of unsampled traces so callers never need to check"""
+    __slots__ = ()
+    sampled = False
+
+    def set(self, **attributes):
+        pass
+
+    def end(self):
+        pass
+
+NOOP_SPAN = NoopSpan()
+
+class Tracer:
+    """Starts sampled traces and appends finished spans to a JSONL file"""
+
+    def __init__(self, enabled=None, sample_rate=None, path=None):
+        self.enabled = TRACING_SETTINGS.get("enabled", False) if enabled is None else enabled
+        self.sample_rate = TRACING_SETTINGS.get("sample_rate", 0.1) if sample_rate is None else sample_rate
+        self.path = path or TRACING_SETTINGS.get("file", "traces.jsonl")
+        self.batch_size = TRACING_SETTINGS.get("batch_size", 100)
+        self._buffer = []
+        # Spans can end on the storage writer thread as well as the event loop
+        self._lock = threading.Lock()
+
+    def start_trace(self, name, **attributes):
+        """Start a root span, deciding here whether the whole trace is recorded"""
+        if not self.enabled or random.random() >= self.sample_rate:
+            return NOOP_SPAN
+        return Span(self, os.urandom(16).hex(), None, name, attributes)
+
+    def start_span(self, name, parent=None, **attributes):
+        """Start a child of the given or current span; outside a sampled trace this records nothing"""
+        parent = parent or _current_span.get()
+        if parent is None or not parent.sampled:
+            return NOOP_SPAN
+        return Span(self, parent.trace_id, parent.span_id, name, attributes)
+
+    def export(self, span):
+        """Buffer a finished span, writing the batch when a root span ends or the buffer fills"""
+        with self._lock:
+            self._buffer.append(span.to_dict())
+            if span.parent_id is not None and len(self._buffer) < self.batch_size:
+                return
+            lines, self._buffer = self._buffer, []
+        try:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write("".join(json.dumps(line) + "\n" for line in lines))
+        except Exception as e:
+            print(f"Error writing trace spans: {str(e)}")
+
+tracer = Tracer()
+
+@contextlib.contextmanager
+def use_span(span, end=True):
+    """Make a span current for the enclosed code, recording any exception on it"""
+    token = _current_span.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.set(error=repr(e))
+        raise
+    finally:
+        _current_span.reset(token)
+        if end:
+            span.end()
+
+def span(name, **attributes):
+    """Time the enclosed code as a child of the current span"""
+    return use_span(tracer.start_span(name, **attributes))
+
+def current_span():
+    """Get the current span, or the no-op span outside a sampled trace"""
+    return _current_span.get() or NOOP_SPAN
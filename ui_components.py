@@ -1,6 +1,8 @@
 import discord
 from discord import ui
 
+from user_data_handler import run_storage
+
 class ModeSelectView(ui.View):
     """View for selecting AI modes"""
     
@@ -23,7 +25,7 @@ class ModeSelectView(ui.View):
         
         async def button_callback(interaction):
             user_id = str(interaction.user.id)
-            self.user_handler.set_user_mode(user_id, mode_id)
+            await run_storage(self.user_handler.set_user_mode, user_id, mode_id)
             mode_info = self.ai_handler.get_mode_info(mode_id)
             await interaction.response.send_message(
                 f"Mode changed to **{mode_info['name']}**!", 
@@ -35,27 +37,76 @@ class ModeSelectView(ui.View):
 
 
 class ChatHistoryView(ui.View):
-    """View for selecting from chat history"""
+    """Paginated view for selecting from chat history"""
     
-    def __init__(self, chats, user_handler, timeout=60):
+    def __init__(self, user_handler, user_id, page_size=10, timeout=60):
         super().__init__(timeout=timeout)
         self.user_handler = user_handler
+        self.user_id = user_id
+        self.page_size = page_size
+        self.page = 0
+        self.chats = []
+        self.total = 0
+        self.load_page()
+    
+    @property
+    def page_count(self):
+        return max(1, -(-self.total // self.page_size))
+    
+    def load_page(self):
+        """Fetch the current page from the chat index and rebuild the buttons"""
+        self.chats, self.total = self.user_handler.get_chat_page(
+            self.user_id, self.page * self.page_size, self.page_size
+        )
+        # The chat list may have shrunk since the last page was shown
+        if not self.chats and self.page > 0:
+            self.page = self.page_count - 1
+            self.chats, self.total = self.user_handler.get_chat_page(
+                self.user_id, self.page * self.page_size, self.page_size
+            )
         
-        # Add buttons for each chat
-        for chat_id, name, _ in chats:
+        self.clear_items()
+        for chat_id, name, _, _ in self.chats:
             self.add_chat_button(chat_id, name)
+        if self.page_count > 1:
+            self.add_page_button("◀ Previous", -1, disabled=self.page == 0)
+            self.add_page_button("Next ▶", 1, disabled=self.page >= self.page_count - 1)
+    
+    def make_embed(self):
+        """Build the embed for the current page"""
+        embed = discord.Embed(
+            title="Your Chat History",
+            description="Select a chat to continue the conversation:",
+            color=discord.Color.gold()
+        )
+        
+        current_chat_id = self.user_handler.get_user_data(self.user_id)["current_chat_id"]
+        for chat_id, name, message_count, updated in self.chats:
+            is_current = chat_id == current_chat_id
+            value = f"{message_count} messages"
+            if updated:
+                value += f" · updated <t:{int(updated)}:R>"
+            embed.add_field(
+                name=f"{name} {'(Current)' if is_current else ''}",
+                value=value,
+                inline=False
+            )
+        
+        if self.page_count > 1:
+            embed.set_footer(text=f"Page {self.page + 1} of {self.page_count} · {self.total} chats")
+        return embed
     
     def add_chat_button(self, chat_id, chat_name):
         """Add a button for a chat"""
         button = ui.Button(
-            label=chat_name,
+            label=chat_name[:80],
             custom_id=f"chat_{chat_id}",
             style=discord.ButtonStyle.secondary
         )
         
         async def button_callback(interaction):
             user_id = str(interaction.user.id)
-            self.user_handler.switch_chat(user_id, chat_id)
+            await run_storage(self.user_handler.switch_chat, user_id, chat_id)
             await interaction.response.send_message(
                 f"Switched to chat: **{chat_name}**", 
                 ephemeral=True
@@ -63,6 +114,23 @@ class ChatHistoryView(ui.View):
         
         button.callback = button_callback
         self.add_item(button)
+    
+    def add_page_button(self, label, step, disabled=False):
+        """Add a button that moves to the previous or next page"""
+        button = ui.Button(
+            label=label,
+            custom_id=f"chatpage_{step}",
+            style=discord.ButtonStyle.primary,
+            disabled=disabled
+        )
+        
+        async def button_callback(interaction):
+            self.page = max(0, self.page + step)
+            self.load_page()
+            await interaction.response.edit_message(embed=self.make_embed(), view=self)
+        
+        button.callback = button_callback
+        self.add_item(button)
 
 
 class ClearConfirmView(ui.View):
@@ -81,7 +149,7 @@ class ClearConfirmView(ui.View):
         )
         
         async def confirm_callback(interaction):
-            self.user_handler.clear_chat(self.user_id)
+            await run_storage(self.user_handler.clear_chat, self.user_id)
             await interaction.response.send_message(
                 "Conversation cleared! The AI will no longer remember your previous messages in this chat.",
                 ephemeral=True
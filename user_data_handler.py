@@ -1,144 +1,550 @@
 import json
 import os
+import time
 import uuid
 import datetime
+import asyncio
+import threading
+import contextlib
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 
 # Import configuration
-from config import BOT_SETTINGS
+from config import BOT_SETTINGS, STORAGE_SETTINGS
+from context_builder import count_tokens
+from conversation import Conversation, compact_user_record, encode_json, snapshot
+from metrics import record_flush
+from tracing import span
+
+# Reserved snapshot key holding the last journal sequence number it includes
+JOURNAL_SEQ_KEY = "_journal_seq"
 
 class UserDataHandler:
-    def __init__(self, data_file=None):
+    def __init__(self, data_file=None, journal=None, write_behind=None):
         """Initialize the user data handler"""
         self.data_file = data_file or BOT_SETTINGS.get("user_data_file", "user_data.json")
+        self.journal_enabled = STORAGE_SETTINGS.get("journal", False) if journal is None else journal
+        self.journal_file = STORAGE_SETTINGS.get("journal_file") or f"{self.data_file}.journal"
+        self.write_behind = STORAGE_SETTINGS.get("write_behind", False) if write_behind is None else write_behind
+        
+        # Guards user_data and the journal against the background writer
+        self._lock = threading.RLock()
+        # Serializes file writes so an older snapshot never replaces a newer one
+        self._write_lock = threading.Lock()
+        self._journal = None
+        self._journal_seq = 0
+        self._journal_records = 0
+        self._pending_records = []
+        self._dirty = 0
+        # Keys a save has yet to serialize (None when no save is running), and copies of those
+        # records taken just before their first change, so the save still writes them as they were
+        self._saving = None
+        self._frozen = {}
+        self._wake_event = threading.Event()
+        self._writer = None
+        self._closed = False
+        
         self.user_data = self.load_data()
+        # (guild_id, channel_id) pairs with auto-replies on, as ints, for lookups that never touch storage
+        self.enabled_channels = self.load_enabled_channels()
+        # Per-guild settings stored next to enabled_channels, keyed by Discord's int guild ID
+        self.guild_settings = self.load_guild_settings()
+        
+        if self.journal_enabled:
+            self._journal = open(self.journal_file, 'a', encoding='utf-8')
+        if self.journal_enabled or self.write_behind:
+            self._writer = threading.Thread(target=self._writer_loop, name="user-data-writer", daemon=True)
+            self._writer.start()
     
     def load_data(self):
-        """Load user data from file"""
+        """Load user data from file, replaying the journal if enabled"""
         try:
             if os.path.exists(self.data_file):
                 with open(self.data_file, 'r') as f:
-                    return json.load(f)
+                    data = json.load(f)
             else:
-                return {}
+                data = {}
         except Exception as e:
             print(f"Error loading user data: {str(e)}")
-            return {}
+            data = {}
+        
+        self._journal_seq = data.pop(JOURNAL_SEQ_KEY, 0)
+        for record in data.values():
+            upgrade_user_record(record)
+        
+        if self.journal_enabled:
+            # A leftover rotated journal means a compaction was interrupted
+            for path in (f"{self.journal_file}.compacting", self.journal_file):
+                self._journal_records += self._replay_journal(data, path)
+        
+        return data
     
     def save_data(self):
         """Save user data to file"""
+        if self.journal_enabled:
+            return self.compact_journal()
+        
         try:
-            with open(self.data_file, 'w') as f:
-                json.dump(self.user_data, f)
+            with self._write_lock, record_flush():
+                with self._lock:
+                    keys = self._begin_save()
+                    self._dirty = 0
+                payload = self._encode_saved_data(keys)
+                self._write_atomic(self.data_file, payload)
             return True
         except Exception as e:
             print(f"Error saving user data: {str(e)}")
             return False
     
+    def flush(self):
+        """Write out changes held back by write-behind mode"""
+        if not self._dirty:
+            return True
+        if not self.journal_enabled:
+            return self.save_data()
+        
+        try:
+            with self._write_lock, record_flush():
+                with self._lock:
+                    lines, self._pending_records = self._pending_records, []
+                    self._dirty = 0
+                    self._write_journal(lines)
+            return True
+        except Exception as e:
+            print(f"Error flushing journal records: {str(e)}")
+            return False
+    
+    def _begin_save(self):
+        """Fix the set of records a save writes, as they are now; call with the lock held"""
+        self._saving = set(self.user_data.keys())
+        self._frozen = {}
+        return list(self._saving)
+    
+    def _encode_saved_data(self, keys, extra=None):
+        """Serialize the records of a save without holding the lock while they're encoded
+        
+        A record changed during the save was copied just before the change (see _changing),
+        and that copy is written instead, so the file matches the moment the save began.
+        """
+        parts = []
+        try:
+            for key in keys:
+                record = self.user_data.get(key)
+                try:
+                    payload = json.dumps(record, default=encode_json)
+                except Exception:
+                    # Changed while it was being encoded; its frozen copy is used below
+                    payload = None
+                with self._lock:
+                    frozen = self._frozen.pop(key, None)
+                    self._saving.discard(key)
+                if frozen is not None:
+                    payload = json.dumps(frozen, default=encode_json)
+                elif payload is None:
+                    raise RuntimeError(f"record {key} could not be encoded")
+                parts.append(f"{json.dumps(key)}: {payload}")
+        finally:
+            with self._lock:
+                self._saving = None
+                self._frozen = {}
+        
+        for key, value in (extra or {}).items():
+            parts.append(f"{json.dumps(key)}: {json.dumps(value)}")
+        return "{" + ", ".join(parts) + "}"
+    
+    @contextlib.contextmanager
+    def _changing(self, key):
+        """Hold the lock while a record changes and its change is persisted
+        
+        Changing a record and assigning its journal sequence number in one critical section keeps
+        a compaction from writing the change into a snapshot that claims an older sequence number.
+        """
+        with self._lock:
+            if self._saving is not None and key in self._saving and key not in self._frozen:
+                self._frozen[key] = snapshot(self.user_data[key])
+            yield
+    
+    def data_size(self):
+        """Get the bytes of user data on disk, including the journal"""
+        return sum(os.path.getsize(path) for path in (self.data_file, self.journal_file) if os.path.exists(path))
+    
+    def _write_atomic(self, path, payload):
+        """Write a file by replacing it with a fully written temporary file"""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    
+    def _write_journal(self, lines):
+        """Append serialized records to the journal"""
+        self._journal.write("".join(lines))
+        self._journal.flush()
+        if STORAGE_SETTINGS.get("journal_fsync", False):
+            os.fsync(self._journal.fileno())
+    
+    def _mark_dirty(self):
+        """Record an unsaved mutation and wake the writer once enough have piled up"""
+        self._dirty += 1
+        if self._dirty >= STORAGE_SETTINGS.get("flush_max_mutations", 100):
+            self._wake_event.set()
+    
+    def _persist(self, op, **fields):
+        """Persist a single mutation, either as a journal record or a full save; call inside _changing"""
+        with span("persist", op=op, write_behind=self.write_behind, journal=self.journal_enabled):
+            self._persist_record(op, fields)
+    
+    def _record_key(self, fields):
+        """Get the user_data key of the record a mutation changed"""
+        return fields["user_id"] if "user_id" in fields else f"guild_{fields['guild_id']}"
+    
+    def _persist_record(self, op, fields):
+        """Write or queue one mutation"""
+        if not self.journal_enabled:
+            if self.write_behind:
+                with self._lock:
+                    self._mark_dirty()
+            else:
+                self.save_data()
+            return
+        
+        try:
+            with self._lock:
+                self._journal_seq += 1
+                line = json.dumps({"seq": self._journal_seq, "op": op, **fields}) + "\n"
+                if self.write_behind:
+                    self._pending_records.append(line)
+                    self._mark_dirty()
+                else:
+                    self._write_journal([line])
+                self._journal_records += 1
+                
+                if self._journal_records >= STORAGE_SETTINGS.get("journal_compact_records", 1000):
+                    self._wake_event.set()
+        except Exception as e:
+            print(f"Error writing journal record: {str(e)}")
+    
+    def _replay_journal(self, data, path):
+        """Apply journal records newer than the snapshot to data"""
+        if not os.path.exists(path):
+            return 0
+        
+        applied = 0
+        with open(path, 'r', encoding='utf-8') as f:
+            for line_number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # A torn final line is expected after a crash mid-write
+                    print(f"Skipping unreadable journal record {path}:{line_number}")
+                    continue
+                
+                if record.get("seq", 0) <= self._journal_seq:
+                    continue
+                
+                try:
+                    self._apply_record(data, record)
+                except Exception as e:
+                    print(f"Error replaying journal record {path}:{line_number}: {str(e)}")
+                self._journal_seq = record["seq"]
+                applied += 1
+        
+        if applied:
+            print(f"Replayed {applied} journal records from {path}")
+        return applied
+    
+    def _apply_record(self, data, record):
+        """Apply a journal record to a user data dict"""
+        op = record["op"]
+        
+        if op in ("enable_channel", "disable_channel"):
+            guild = data.setdefault(f"guild_{record['guild_id']}", {"enabled_channels": []})
+            channel_id = record["channel_id"]
+            if op == "enable_channel" and channel_id not in guild["enabled_channels"]:
+                guild["enabled_channels"].append(channel_id)
+            elif op == "disable_channel" and channel_id in guild["enabled_channels"]:
+                guild["enabled_channels"].remove(channel_id)
+            return
+        if op == "set_guild_setting":
+            guild = data.setdefault(f"guild_{record['guild_id']}", {"enabled_channels": []})
+            if record["value"] is None:
+                guild.pop(record["name"], None)
+            else:
+                guild[record["name"]] = record["value"]
+            return
+        
+        user = data.setdefault(record["user_id"], self._new_user_record())
+        conversations = user["conversations"]
+        
+        if op == "add_message":
+            conversations.setdefault(record["chat_id"], Conversation()).append_record(record["message"])
+            self._update_chat_index(user, record["chat_id"], record["message"].get("timestamp"))
+        elif op == "create_new_chat":
+            conversations[record["chat_id"]] = Conversation()
+            self._index_chat(user, record["chat_id"], record["name"], record.get("created"))
+            user["current_chat_id"] = record["chat_id"]
+        elif op == "switch_chat":
+            user["current_chat_id"] = record["chat_id"]
+        elif op == "clear_chat":
+            conversations[record["chat_id"]] = Conversation()
+            self._update_chat_index(user, record["chat_id"])
+            user.get("summaries", {}).pop(record["chat_id"], None)
+        elif op == "set_summary":
+            self._apply_summary(user, record["chat_id"], record["content"], record["covered"], record["prune"])
+        elif op == "set_user_mode":
+            user["current_mode"] = record["mode"]
+        else:
+            raise ValueError(f"unknown journal operation '{op}'")
+    
+    def compact_journal(self):
+        """Fold the journal into a fresh snapshot of the data file"""
+        rotated = f"{self.journal_file}.compacting"
+        
+        try:
+            with self._write_lock, record_flush():
+                with self._lock:
+                    keys = self._begin_save()
+                    journal_seq = self._journal_seq
+                    
+                    # Held-back records are already part of the snapshot
+                    self._pending_records = []
+                    self._dirty = 0
+                    
+                    # Rotate the journal so new records keep flowing while the snapshot is written
+                    if self._journal:
+                        self._journal.close()
+                    if os.path.exists(self.journal_file):
+                        os.replace(self.journal_file, rotated)
+                    self._journal = None if self._closed else open(self.journal_file, 'a', encoding='utf-8')
+                    self._journal_records = 0
+                
+                payload = self._encode_saved_data(keys, {JOURNAL_SEQ_KEY: journal_seq})
+                self._write_atomic(self.data_file, payload)
+                if os.path.exists(rotated):
+                    os.remove(rotated)
+            return True
+        except Exception as e:
+            print(f"Error compacting journal: {str(e)}")
+            return False
+    
+    def _writer_loop(self):
+        """Flush held-back changes and compact the journal in the background"""
+        flush_interval = STORAGE_SETTINGS.get("flush_interval_ms", 500) / 1000
+        compact_interval = STORAGE_SETTINGS.get("journal_compact_interval", 300)
+        compact_records = STORAGE_SETTINGS.get("journal_compact_records", 1000)
+        last_compaction = time.monotonic()
+        
+        while not self._closed:
+            self._wake_event.wait(flush_interval if self.write_behind else compact_interval)
+            self._wake_event.clear()
+            if self._closed:
+                break
+            
+            if self.write_behind:
+                self.flush()
+            
+            if self.journal_enabled and self._journal_records:
+                now = time.monotonic()
+                if self._journal_records >= compact_records or now - last_compaction >= compact_interval:
+                    self.compact_journal()
+                    last_compaction = now
+    
+    def close(self):
+        """Flush everything to disk and stop background work; call on shutdown"""
+        if self._closed:
+            return
+        self._closed = True
+        if self._writer:
+            self._wake_event.set()
+            self._writer.join(timeout=10)
+        
+        if self.journal_enabled:
+            self.compact_journal()
+        elif self.write_behind:
+            self.flush()
+    
+    def _new_user_record(self):
+        """Build the initial record for a new user"""
+        now = time.time()
+        return {
+            "current_mode": BOT_SETTINGS.get("default_mode", "general_chatting"),
+            "current_chat_id": "default",
+            "conversations": {"default": Conversation()},
+            "chats": {"default": {"name": None, "created": now, "updated": now, "count": 0}}
+        }
+    
+    def _index_chat(self, user, chat_id, name, created=None):
+        """Add a new chat to the user's chat metadata index"""
+        created = created or time.time()
+        user.setdefault("chats", {})[chat_id] = {"name": name, "created": created, "updated": created, "count": 0}
+    
+    def _update_chat_index(self, user, chat_id, updated=None):
+        """Refresh a chat's message count, and its last update time if given"""
+        meta = user.setdefault("chats", {}).setdefault(chat_id, {"name": None, "created": updated, "updated": updated})
+        meta["count"] = len(user["conversations"][chat_id])
+        if updated:
+            meta["updated"] = updated
+    
     def get_user_data(self, user_id):
         """Get user data, initializing if it doesn't exist"""
         if user_id not in self.user_data:
-            self.user_data[user_id] = {
-                "current_mode": BOT_SETTINGS.get("default_mode", "general_chatting"),
-                "current_chat_id": "default",
-                "conversations": {"default": []}
-            }
+            self.user_data[user_id] = self._new_user_record()
         return self.user_data[user_id]
     
+    def _guild_records(self):
+        """Yield (guild_id, record) for every stored guild, with the ID as an int"""
+        for key, record in self.user_data.items():
+            if key.startswith("guild_"):
+                yield int(key[len("guild_"):]), record
+    
+    def load_enabled_channels(self):
+        """Build the set of enabled (guild_id, channel_id) pairs from stored guild records"""
+        enabled = set()
+        for guild_id, record in self._guild_records():
+            enabled.update((guild_id, int(channel_id)) for channel_id in record.get("enabled_channels", []))
+        return enabled
+    
+    def load_guild_settings(self):
+        """Build the per-guild settings map from stored guild records"""
+        settings = {}
+        for guild_id, record in self._guild_records():
+            values = {name: value for name, value in record.items() if name != "enabled_channels"}
+            if values:
+                settings[guild_id] = values
+        return settings
+    
+    def get_guild_setting(self, guild_id, name, default=None):
+        """Get a guild setting; takes Discord's int guild ID and never touches storage"""
+        return self.guild_settings.get(guild_id, {}).get(name, default)
+    
+    def set_guild_setting(self, guild_id, name, value):
+        """Store a guild setting, or remove it when value is None"""
+        with self._changing(f"guild_{guild_id}"):
+            guild_data = self.user_data.setdefault(f"guild_{guild_id}", {"enabled_channels": []})
+            settings = self.guild_settings.setdefault(int(guild_id), {})
+            if value is None:
+                guild_data.pop(name, None)
+                settings.pop(name, None)
+            else:
+                guild_data[name] = value
+                settings[name] = value
+            self._persist("set_guild_setting", guild_id=guild_id, name=name, value=value)
+    
+    def is_channel_enabled(self, guild_id, channel_id):
+        """Check whether a channel has auto-replies on; takes Discord's int IDs and never touches storage"""
+        return (guild_id, channel_id) in self.enabled_channels
+    
     def get_guild_data(self, guild_id):
-        """Get guild data, initializing if it doesn't exist"""
+        """Get guild data; guilds without a record get an unsaved empty one"""
         # Use a special prefix to distinguish guild data from user data
         guild_key = f"guild_{guild_id}"
         
         if guild_key not in self.user_data:
-            self.user_data[guild_key] = {
-                "enabled_channels": []
-            }
+            return {"enabled_channels": []}
         return self.user_data[guild_key]
     
     def enable_channel(self, guild_id, channel_id):
         """Enable a channel for automatic AI responses"""
-        guild_data = self.get_guild_data(guild_id)
-        
-        # Check if channel is already enabled
-        if channel_id in guild_data["enabled_channels"]:
-            return False
-        
-        # Add channel to enabled list
-        guild_data["enabled_channels"].append(channel_id)
-        self.save_data()
+        with self._changing(f"guild_{guild_id}"):
+            guild_data = self.user_data.setdefault(f"guild_{guild_id}", {"enabled_channels": []})
+            
+            # Check if channel is already enabled
+            if channel_id in guild_data["enabled_channels"]:
+                return False
+            
+            # Add channel to enabled list
+            guild_data["enabled_channels"].append(channel_id)
+            self.enabled_channels.add((int(guild_id), int(channel_id)))
+            self._persist("enable_channel", guild_id=guild_id, channel_id=channel_id)
         return True
     
     def disable_channel(self, guild_id, channel_id):
         """Disable a channel for automatic AI responses"""
-        guild_data = self.get_guild_data(guild_id)
-        
-        # Check if channel is enabled
-        if channel_id not in guild_data["enabled_channels"]:
-            return False
-        
-        # Remove channel from enabled list
-        guild_data["enabled_channels"].remove(channel_id)
-        self.save_data()
+        with self._changing(f"guild_{guild_id}"):
+            guild_data = self.get_guild_data(guild_id)
+            
+            # Check if channel is enabled
+            if channel_id not in guild_data["enabled_channels"]:
+                return False
+            
+            # Remove channel from enabled list
+            guild_data["enabled_channels"].remove(channel_id)
+            self.enabled_channels.discard((int(guild_id), int(channel_id)))
+            self._persist("disable_channel", guild_id=guild_id, channel_id=channel_id)
         return True
     
     def set_user_mode(self, user_id, mode):
         """Set the user's current AI mode"""
-        user = self.get_user_data(user_id)
-        user["current_mode"] = mode
-        self.save_data()
+        with self._changing(user_id):
+            user = self.get_user_data(user_id)
+            user["current_mode"] = mode
+            self._persist("set_user_mode", user_id=user_id, mode=mode)
     
     def create_new_chat(self, user_id, name=None):
         """Create a new chat for the user"""
-        user = self.get_user_data(user_id)
-        
         # Generate chat ID and name
         chat_id = str(uuid.uuid4())
         if not name:
             name = f"Chat {datetime.datetime.now().strftime('%Y-%m-%d %H:%M')}"
         
         # Create new chat
-        user["conversations"][chat_id] = []
-        user["current_chat_id"] = chat_id
-        user["conversations"][chat_id + "_name"] = name
-        self.save_data()
+        created = time.time()
+        with self._changing(user_id):
+            user = self.get_user_data(user_id)
+            user["conversations"][chat_id] = Conversation()
+            user["current_chat_id"] = chat_id
+            self._index_chat(user, chat_id, name, created)
+            self._persist("create_new_chat", user_id=user_id, chat_id=chat_id, name=name, created=created)
         
         return chat_id, name
     
     def get_chat_history(self, user_id):
-        """Get the user's chat history"""
+        """Get the user's chats as (chat_id, name, message_count), most recently updated first"""
+        chats, _ = self.get_chat_page(user_id, 0, None)
+        return [(chat_id, name, count) for chat_id, name, count, _ in chats]
+    
+    def get_chat_page(self, user_id, offset, limit):
+        """Get one page of (chat_id, name, message_count, updated) from the chat index, and the total chat count"""
         user = self.get_user_data(user_id)
+        with self._lock:
+            chats = [(chat_id, meta) for chat_id, meta in user.get("chats", {}).items() if chat_id != "default"]
+        chats.sort(key=lambda item: item[1]["updated"] or 0, reverse=True)
         
-        chats = []
-        for chat_id in user["conversations"]:
-            if not chat_id.endswith("_name") and chat_id != "default":
-                name = user["conversations"].get(chat_id + "_name", f"Chat {chat_id[:8]}")
-                message_count = len(user["conversations"][chat_id])
-                chats.append((chat_id, name, message_count))
-        
-        return chats
+        end = None if limit is None else offset + limit
+        page = [
+            (chat_id, meta["name"] or f"Chat {chat_id[:8]}", meta["count"], meta["updated"])
+            for chat_id, meta in chats[offset:end]
+        ]
+        return page, len(chats)
     
     def switch_chat(self, user_id, chat_id):
         """Switch the user to a different chat"""
-        user = self.get_user_data(user_id)
-        
-        if chat_id in user["conversations"]:
+        with self._changing(user_id):
+            user = self.get_user_data(user_id)
+            if chat_id not in user["conversations"]:
+                return False
             user["current_chat_id"] = chat_id
-            self.save_data()
-            return True
-        return False
+            self._persist("switch_chat", user_id=user_id, chat_id=chat_id)
+        return True
     
     def clear_chat(self, user_id, chat_id=None):
         """Clear a user's chat history"""
-        user = self.get_user_data(user_id)
-        
-        if not chat_id:
-            chat_id = user["current_chat_id"]
-        
-        if chat_id in user["conversations"]:
-            user["conversations"][chat_id] = []
-            self.save_data()
-            return True
-        return False
+        with self._changing(user_id):
+            user = self.get_user_data(user_id)
+            
+            if not chat_id:
+                chat_id = user["current_chat_id"]
+            
+            if chat_id not in user["conversations"]:
+                return False
+            user["conversations"][chat_id] = Conversation()
+            self._update_chat_index(user, chat_id)
+            user.get("summaries", {}).pop(chat_id, None)
+            self._persist("clear_chat", user_id=user_id, chat_id=chat_id)
+        return True
     
     def add_message(self, user_id, role, content):
         """Add a message to the user's current conversation"""
@@ -146,15 +552,19 @@ class UserDataHandler:
         if content is None or (isinstance(content, str) and not content.strip()):
             print(f"Warning: Attempted to add message with empty content for user {user_id}")
             return
-            
-        user = self.get_user_data(user_id)
-        chat_id = user["current_chat_id"]
         
-        user["conversations"][chat_id].append({
+        message = {
             "role": role,
-            "content": content
-        })
-        self.save_data()
+            "content": content,
+            "timestamp": time.time(),
+            "tokens": count_tokens(content)
+        }
+        with self._changing(user_id):
+            user = self.get_user_data(user_id)
+            chat_id = user["current_chat_id"]
+            user["conversations"][chat_id].append_record(message)
+            self._update_chat_index(user, chat_id, message["timestamp"])
+            self._persist("add_message", user_id=user_id, chat_id=chat_id, message=message)
     
     def get_conversation(self, user_id, chat_id=None):
         """Get a user's conversation"""
@@ -163,9 +573,86 @@ class UserDataHandler:
         if not chat_id:
             chat_id = user["current_chat_id"]
         
-        return user["conversations"].get(chat_id, [])
+        conversation = user["conversations"].get(chat_id)
+        return conversation if conversation is not None else Conversation()
     
     def get_current_mode(self, user_id):
         """Get the user's current AI mode"""
         user = self.get_user_data(user_id)
         return user["current_mode"]
+    
+    def get_summary(self, user_id, chat_id=None):
+        """Get the rolling summary of a conversation's older messages"""
+        user = self.get_user_data(user_id)
+        
+        if not chat_id:
+            chat_id = user["current_chat_id"]
+        
+        return user.get("summaries", {}).get(chat_id)
+    
+    def set_summary(self, user_id, chat_id, content, covered, prune=False):
+        """Store a summary of a chat's first `covered` messages, optionally dropping those messages"""
+        with self._changing(user_id):
+            user = self.get_user_data(user_id)
+            if chat_id not in user["conversations"]:
+                return False
+            self._apply_summary(user, chat_id, content, covered, prune)
+            self._persist("set_summary", user_id=user_id, chat_id=chat_id, content=content, covered=covered, prune=prune)
+        return True
+    
+    def _apply_summary(self, user, chat_id, content, covered, prune):
+        """Record a summary on a user record"""
+        if prune:
+            user["conversations"][chat_id].drop_first(covered)
+            self._update_chat_index(user, chat_id)
+            covered = 0
+        user.setdefault("summaries", {})[chat_id] = {
+            "content": content,
+            "covered": covered
+        }
+
+def upgrade_user_record(record):
+    """Bring a loaded record up to the current in-memory format"""
+    compact_user_record(record)
+    conversations = record.get("conversations")
+    if conversations is None or "chats" in record:
+        return record
+    
+    # Records saved before the chat index kept chat names in "<chat_id>_name" keys
+    chats = {}
+    for chat_id in [key for key in conversations if not key.endswith("_name")]:
+        conversation = conversations[chat_id]
+        first = conversation[0].timestamp if len(conversation) else 0.0
+        last = conversation[len(conversation) - 1].timestamp if len(conversation) else 0.0
+        chats[chat_id] = {
+            "name": conversations.get(chat_id + "_name"),
+            "created": first,
+            "updated": last,
+            "count": len(conversation)
+        }
+    for key in [key for key in conversations if key.endswith("_name")]:
+        del conversations[key]
+    record["chats"] = chats
+    return record
+
+# Storage calls made from the event loop run here, one at a time and in order, so a backend
+# waiting on a lock (SQLite's busy timeout when clusters share a database) never stalls the loop
+storage_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="user-data")
+
+async def run_storage(func, *args):
+    """Run a user data handler call on the storage thread, keeping the caller's trace context"""
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(storage_executor, context.run, func, *args)
+
+def create_user_data_handler():
+    """Create the user data handler for the configured storage backend"""
+    backend = STORAGE_SETTINGS.get("backend", "json")
+    if backend == "sqlite":
+        from sqlite_storage import SQLiteUserDataHandler
+        return SQLiteUserDataHandler()
+    if backend == "sharded":
+        from sharded_storage import ShardedUserDataHandler
+        return ShardedUserDataHandler()
+    if backend != "json":
+        print(f"Unknown storage backend '{backend}', falling back to JSON")
+    return UserDataHandler()